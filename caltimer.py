@@ -28,34 +28,146 @@
 
 import logging
 import sys
+import sqlite3
+import os
 import configparser
 import subprocess
-import sched
+import asyncio
+import heapq
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import time
-from datetime import datetime, date, timedelta
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, date, timedelta, timezone
 from random import uniform
-import caldav
-# from caldav.elements import dav, cdav
-from sunrise_sunset import SunriseSunset
-import RPi.GPIO as GPIO
-from rpi_rf import RFDevice
+from bisect import bisect_left
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+import importlib
+import vobject
 import argparse
-import requests
-import serial
+import signal
+import socket
+import socketserver
+import json
+import struct
+
+# Libraries which are only imported when they are used: the calendar
+# client, NumPy for the sun table and the hardware libraries of the
+# switch backends (RPi.GPIO, rpi_rf, serial)
+caldav = None
+numpy = None
+GPIO = None
+serial = None
+RFDevice = None
 
 # Default pulse length definitions
-# Can be overwritten from ini file settings
+# Can be overwritten from ini file settings (DEFAULT or switch section)
 pulse_comag = 350
 pulse_zap = 187
 kopp_time = '00100'
+# XML name spaces of CalDAV and the calendarserver extensions (getctag)
+NS_C = 'urn:ietf:params:xml:ns:caldav'
+NS_CS = 'http://calendarserver.org/ns/'
+# Maximum number of objects per calendar-multiget REPORT
+MULTIGET_SIZE = 500
+# Number of HTTP requests to the calendar server
+dav_requests = 0
+# HTTP session shared by the calendar clients and the geocoding
+session = None
+# Responses of GET requests with ETag kept by the session
+ETAG_CACHE = 64
+# Sunrise/sunset table, created by get_sun()
+sun_table = None
+# Compiled switches and groups, created by compile_switches()
+switches = {}
+groups = {}
+# Connections to the switch agents by address, created by open_agents()
+agents = {}
+# RF transmitters and nanoCULs by lane, created by use_transmitters()
+transmitters = {}
+# (kind, GPIO pin / codesend command / serial port): lane
+transmitter_lanes = {}
+# time of the last failure of a transmitter by lane
+transmitter_failed = {}
+# Seconds a failed transmitter is only used if the switch has no other,
+# option failover_time of the ini file
+failover_time = 600
+# Hardware calls go to the SimBackend of the simulator s
+simulated = False
 switch_state = {
     True:  "ON",
     False: "OFF",
     }
 
+# RF protocols (same as rpi-rf and 433Utils): pulses of the sync and
+# of each bit
+rf_protocols = {
+    1: (32, 4),
+    2: (11, 3),
+    3: (101, 15),
+    4: (7, 4),
+    5: (20, 3),
+    6: (24, 3),
+    }
+
 # Define time gap for 2nd switch event. None if set to 0.
 second_switch = 10
 
+# Binary timeline of the --compile mode, read by caltimer_exec.py
+TIMELINE_MAGIC = b'CTTL'
+TIMELINE_VERSION = 1
+TIMELINE_HEADER = struct.Struct('<4sIII')
+TIMELINE_RECORD = struct.Struct('<dHBBI')
+TIMELINE_KINDS = ('dummy', 'gpio', 'codesend', 'rpi-rf', 'kopp')
+
+# Dispatch timer: the last seconds before an action are waited in its
+# executor thread, longer waits are checked against the wall clock at
+# least every CLOCK_CHECK seconds
+FINE_WAIT = 0.05
+CLOCK_CHECK = 60
+
+# Modes of the [sun] start and end options
+SUN_MODES = ('rise', 'set', 'before rise', 'after rise', 'before set',
+             'after set')
+# Compiled event descriptions: description: EventRule
+event_rules = {}
+RULE_CACHE = 10000
+
+# Switch commands of the current interval:
+# (time, sequence, switch, onoff, (earliest, latest time of the command))
+plan = []
+
+# Runtime metrics (Prometheus text format): name: (type, help)
+METRICS = {
+    'caltimer_fetch_seconds':
+        ('gauge', 'Duration of the last calendar fetch'),
+    'caltimer_dav_requests':
+        ('gauge', 'HTTP round trips of the last calendar fetch'),
+    'caltimer_window_events':
+        ('gauge', 'Calendar events of the last scheduler interval'),
+    'caltimer_parse_seconds':
+        ('gauge', 'Duration of the last parse and expansion of the events'),
+    'caltimer_schedule_seconds':
+        ('gauge', 'Duration of the last planning of the switch events'),
+    'caltimer_queue_depth':
+        ('gauge', 'Due switch actions waiting in the dispatcher lane'),
+    'caltimer_fire_lateness_seconds':
+        ('histogram', 'Actual minus planned time of the switch actions'),
+    'caltimer_transmit_latency_seconds':
+        ('histogram', 'Delay of the RF transmit worker'),
+    'caltimer_errors_total':
+        ('counter', 'Failed switch commands per switch type'),
+    'caltimer_suppressed_total':
+        ('counter', 'Switch commands dropped as the switch was already in '
+                    'that state'),
+    'caltimer_last_interval_timestamp_seconds':
+        ('gauge', 'Start of the last scheduled interval'),
+    }
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 # set initial logging to stderr, level INFO
 logging.basicConfig(
     stream=sys.stderr,
@@ -63,41 +175,1186 @@ logging.basicConfig(
     level=logging.INFO)
 
 
-def send_ser(code):
-    try:
-        ser.write(code.encode()+b'\n')
-        logging.debug('Serial send code = %s', code)
-    except:
-        logging.error("Tried to send code %s, but serial port not defined "
-                      "or available.", code)
+class Metrics:
+    # Runtime metrics of caltimer in the Prometheus text format, written
+    # to a textfile (node exporter textfile collector) and/or served by a
+    # local HTTP endpoint. Counters and histograms of a previous run are
+    # loaded from the textfile, so they keep counting across cron runs.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (sample name, labels): value
+        self.samples = {}
+
+    def family(self, name):
+        # metric name of a sample name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if (name.endswith(suffix) and name[:-len(suffix)] in METRICS
+                    and METRICS[name[:-len(suffix)]][0] == 'histogram'):
+                return name[:-len(suffix)]
+        return name
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.samples[(name, tuple(labels.items()))] = value
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        labels = tuple(labels.items())
+        with self.lock:
+            for bound in METRICS_BUCKETS + (float('inf'),):
+                key = (name + '_bucket', labels + (
+                    ('le', '+Inf' if bound == float('inf') else str(bound)),))
+                self.samples[key] = (self.samples.get(key, 0)
+                                     + (value <= bound))
+            for suffix, add in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, labels)
+                self.samples[key] = self.samples.get(key, 0) + add
+
+    def text(self):
+        with self.lock:
+            samples = list(self.samples.items())
+        lines = []
+        for family, (type, help) in METRICS.items():
+            family_samples = [(name, labels, value)
+                              for (name, labels), value in samples
+                              if self.family(name) == family]
+            if not family_samples:
+                continue
+            lines.append('# HELP %s %s' % (family, help))
+            lines.append('# TYPE %s %s' % (family, type))
+            for name, labels, value in family_samples:
+                if labels:
+                    name += '{%s}' % ','.join(
+                        '%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                     .replace('\n', '\\n')
+                                     .replace('"', '\\"'))
+                        for k, v in labels)
+                value = float(value)
+                lines.append('%s %s' % (name, int(value) if value.is_integer()
+                                        else repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def load(self, filename):
+        # continue the counters and histograms of the last textfile
+        try:
+            with open(filename) as f:
+                text = f.read()
+        except OSError:
+            return
+        for line in text.splitlines():
+            match = re.match(r'(\w+)(?:\{(.*)\})? (\S+)$', line)
+            if match is None:
+                continue
+            name, labels, value = match.groups()
+            if METRICS.get(self.family(name), ('gauge',))[0] == 'gauge':
+                continue
+            # the raw label values, text() escapes them again
+            labels = tuple(
+                (k, re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                           else m.group(1), v))
+                for k, v in re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"',
+                                       labels or ''))
+            self.samples[(name, labels)] = float(value)
+
+    def write(self, filename):
+        # replace the textfile atomically, so the collector never reads
+        # a partial file
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                f.write(self.text())
+            os.replace(filename + '.tmp', filename)
+        except OSError as e:
+            logging.error('Unable to write metrics file %s: %s', filename, e)
+
+    def serve(self, address, port):
+        # HTTP endpoint for the metrics in a background thread
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = metrics.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
 
+        try:
+            server = ThreadingHTTPServer((address, port), Handler)
+        except OSError as e:
+            logging.error('Unable to serve metrics on %s:%s: %s', address,
+                          port, e)
+            return
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics',
+                         daemon=True).start()
+        logging.info('Metrics served on http://%s:%s/metrics', address,
+                     port)
+
+
+metrics = Metrics()
+
+
+class CulTransport(threading.Thread):
+    # Persistent nanoCUL serial channel: the frames are queued (bounded, a
+    # full queue blocks the serial lane) and written by this thread, up to
+    # `batch` frames in one write. culfw processes the commands one after
+    # the other, so the reply to the version command 'V' appended to each
+    # write confirms all frames before it. Unconfirmed batches are resent
+    # after reopening the port, and then by another nanoCUL of the switch.
+
+    def __init__(self, port, baudrate=38400, queue_size=32, batch=4,
+                 timeout=1.0, retries=2, lane='serial'):
+        super().__init__(name='nanocul %s' % port, daemon=True)
+        self.lane = lane
+        self.port = port
+        self.baudrate = baudrate
+        self.batch = batch
+        self.timeout = timeout
+        self.retries = retries
+        self.queue = queue.Queue(queue_size)
+        self.ser = None
+        # statistics
+        self.confirmed = 0
+        self.failed = 0
+        self.resent = 0
+        self.reopened = 0
+        self.max_depth = 0
+
+    def open(self):
+        if self.ser is not None:
+            return True
+        try:
+            self.ser = serial.Serial(self.port, self.baudrate, timeout=0.1)
+        except (serial.SerialException, OSError) as e:
+            logging.error("Can't open serial port %s: %s", self.port, e)
+            return False
+        logging.debug('Serial port %s opened', self.port)
+        self.reopened += 1
+        return True
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.ser = None
+
+    def send(self, code):
+        # called by the serial lane, blocks while the queue is full
+        if self.queue.full():
+            logging.warning('nanoCUL queue full, waiting to send %s', code)
+        self.queue.put(code)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def write(self, frames):
+        # write the frames plus the version barrier and wait for its reply
+        if not self.open():
+            return False
+        try:
+            self.ser.reset_input_buffer()
+            self.ser.write(''.join(f + '\n' for f in frames + ['V'])
+                           .encode())
+            deadline = time.monotonic() + self.timeout * (len(frames) + 1)
+            while time.monotonic() < deadline:
+                line = self.ser.readline().strip()
+                if line:
+                    logging.debug('nanoCUL reply: %s', line)
+                if line.startswith(b'V'):
+                    return True
+            logging.warning('No reply from nanoCUL for %s', frames)
+        except (serial.SerialException, OSError) as e:
+            logging.warning('Serial port %s failed: %s', self.port, e)
+        # reopen before the next try
+        self.close()
+        return False
 
-def rf_switch(switch, onoff, stime):
-    if onoff:
-        sendcode = config[switch]['oncode']
-    else:
-        sendcode = config[switch]['offcode']
-    logging.info('<<< rf_switch schedule to send %s code %s for switch %s '
-                 'at time %s via %s',
-                 switch_state[onoff], sendcode, switch,
-                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)),
-                 config[switch]['rf_code'])
-    if config[switch]['rf_code'] == "rf433":
-        s.enterabs(stime, 1, subprocess.call,
-                   argument=([config['DEFAULT']['rf433'], sendcode,
-                              config[switch]['protocol'],
-                              config[switch]['pulselength']],))
-    elif config[switch]['rf_code'] == "rpi-rf":
-        s.enterabs(stime, 1, rfdevice.tx_code, argument=(
-            int(sendcode), int(config[switch]['protocol']),
-            int(config[switch]['pulselength'])))
+    def run(self):
+        while True:
+            frames = [self.queue.get()]
+            while frames[-1] is not None and len(frames) < self.batch:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = frames[-1] is None
+            if stop:
+                frames.pop()
+            if frames:
+                for attempt in range(self.retries + 1):
+                    if attempt:
+                        self.resent += len(frames)
+                        time.sleep(self.timeout)
+                    if self.write(frames):
+                        logging.debug('Serial send codes = %s', frames)
+                        self.confirmed += len(frames)
+                        break
+                else:
+                    logging.error('Serial codes %s not confirmed by the '
+                                  'nanoCUL %s', frames, self.port)
+                    self.failed += len(frames)
+                    for frame in frames:
+                        if not failover(self.lane, (frame,)):
+                            metrics.inc('caltimer_errors_total',
+                                        type='kopp')
+            for _ in range(len(frames) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def stop(self):
+        # send the remaining frames, stop the thread and close the port
+        self.queue.put(None)
+        self.join()
+        self.close()
+        if self.confirmed or self.failed:
+            logging.info('nanoCUL %s confirmed %s frames, %s failed, %s '
+                         'resent, port opened %s times, max queue depth %s',
+                         self.port, self.confirmed, self.failed, self.resent,
+                         self.reopened, self.max_depth)
+
+
+class TransmitWorker(threading.Thread):
+    # Long running RF transmitter: the scheduler only puts the codes into
+    # the queue and the worker sends them back to back, so a transmission
+    # doesn't block the following scheduler events.
+    # rpi-rf codes are sent by the RFDevice opened once, rf433 codes by
+    # codesend (which can only send a single code per call). A code which
+    # can't be sent is passed to another transmitter of the switch.
+
+    def __init__(self, lane='rf', device=None, command=None):
+        super().__init__(name='rf-transmit %s' % lane, daemon=True)
+        self.lane = lane
+        self.device = device
+        self.command = command
+        self.queue = queue.Queue()
+        # enqueue to air latency statistics
+        self.sent = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def send(self, code, protocol, pulselength, type='rf'):
+        # called by the scheduler at the switch time
+        self.queue.put((time.time(), (code, protocol, pulselength, type)))
+
+    def transmit(self, code, protocol, pulselength):
+        if self.device is not None:
+            if self.device.tx_code(code, protocol, pulselength) is False:
+                raise RuntimeError('rpi-rf could not send the code')
+        else:
+            result = subprocess.call([self.command, str(code), str(protocol),
+                                      str(pulselength)])
+            if result != 0:
+                raise RuntimeError('codesend exit code %s' % result)
+
+    def run(self):
+        while True:
+            queued, args = self.queue.get()
+            if args is None:
+                self.queue.task_done()
+                return
+            latency = time.time() - queued
+            metrics.observe('caltimer_transmit_latency_seconds', latency)
+            try:
+                self.transmit(*args[:3])
+            except Exception as e:
+                logging.error('RF transmit of %s by %s failed: %s', args,
+                              self.lane, e)
+                if not failover(self.lane, args):
+                    metrics.inc('caltimer_errors_total', type=args[3])
+            self.sent += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            logging.debug('RF code %s sent, %.3f s after enqueue', args,
+                          latency)
+            self.queue.task_done()
+
+    def stop(self):
+        # send the remaining codes and stop the worker
+        self.queue.put((time.time(), None))
+        self.join()
+        if self.device is not None:
+            self.device.cleanup()
+        if self.sent:
+            logging.info('RF transmit worker %s sent %s codes, enqueue to '
+                         'air latency avg %.3f s, max %.3f s', self.lane,
+                         self.sent, self.latency_sum / self.sent,
+                         self.latency_max)
+
+
+def failover(lane, args):
+    # Send the command args of the failed transmitter lane again by another
+    # transmitter of its switch, planned by the airtime planner. Returns
+    # False if there is none.
+    transmitter_failed[lane] = time.time()
+    sw = next((sw for sw in switches.values()
+               if len(sw.transmitters) > 1 and args in (sw.on, sw.off)),
+              None)
+    if sw is None:
+        return False
+    other = airtime.resend(sw, args == sw.on, lane)
+    if other is None:
+        return False
+    logging.warning('Transmitter %s failed, switching %s by %s', lane,
+                    sw.name, other)
+    return True
+
+
+def transmitter_down(lane):
+    # the transmitter failed within the last failover_time seconds
+    return transmitter_failed.get(lane, 0) > time.time() - failover_time
+
+
+def agent_address(address):
+    # socket family and address of "host:port" or a Unix socket path
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+class AgentClient:
+    # Connection of the planner to a switch agent (caltimer --agent).
+    # The switch commands of an interval are collected and pushed to the
+    # agent in one message after the planning, with the switch times
+    # converted to the agent clock. The clock offset is measured with
+    # each push (NTP style, best of a few round trips).
+
+    def __init__(self, address, key=None, timeout=5.0):
+        self.address = address
+        self.key = key
+        self.timeout = timeout
+        self.sock = None
+        self.file = None
+        self.pending = []
+        self.offset = 0.0
+
+    def connect(self):
+        family, address = agent_address(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(address)
+        except OSError:
+            self.close()
+            raise
+        self.file = self.sock.makefile('rwb')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.file = None
+
+    def request(self, message):
+        if self.key is not None:
+            message['key'] = self.key
+        self.file.write(json.dumps(message).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('connection closed by agent')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply
+
+    def sync_clock(self, samples=3):
+        # offset = agent clock - planner clock of the fastest round trip
+        best = None
+        for _ in range(samples):
+            t0 = time.time()
+            t1 = self.request({'op': 'time'})['time']
+            t2 = time.time()
+            if best is None or t2 - t0 < best[0]:
+                best = (t2 - t0, t1 - (t0 + t2) / 2)
+        self.offset = best[1]
+        logging.debug('Agent %s clock offset %+.3f s, round trip %.3f s',
+                      self.address, self.offset, best[0])
+
+    def push(self, name, onoff, stime):
+        # called by schedule_agent
+        self.pending.append((name, onoff, stime))
+
+    def flush(self):
+        # send the pending commands, reconnect once if the agent failed
+        if not self.pending:
+            return
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sync_clock()
+                reply = self.request({
+                    'op': 'schedule',
+                    'commands': [(name, onoff, stime + self.offset)
+                                 for name, onoff, stime in self.pending]})
+                break
+            except (OSError, ValueError) as e:
+                logging.warning('Agent %s failed: %s', self.address, e)
+                self.close()
+        else:
+            logging.error('Unable to send %s switch commands to agent %s',
+                          len(self.pending), self.address)
+            metrics.inc('caltimer_errors_total', len(self.pending),
+                        type='agent')
+            self.pending = []
+            return
+        logging.info('Sent %s switch commands to agent %s',
+                     reply['scheduled'], self.address)
+        # journal the commands when they are due at the agent
+        for name, onoff, stime in self.pending:
+            s.enterabs(stime, 1, journal.record, (name, onoff, stime),
+                       lane='agent %s' % self.address)
+        self.pending = []
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    # Agent side of the protocol: one JSON message per line
+    #   {"op": "time"} -> {"time": agent clock}
+    #   {"op": "schedule", "commands": [[switch, onoff, time], ...]}
+    #       -> {"scheduled": count}, or an error if a switch isn't one
+    #          of the agent
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.reply(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': 'invalid message: %s' % e}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.BaseServer):
+    # Switch agent: runs the commands of the planner with the locally
+    # compiled switches on the local dispatcher
+    daemon_threads = True
+
+    def __init__(self, address, key=None):
+        self.key = key
+        self.lock = threading.Lock()
+        family, self.bind_address = agent_address(address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        socketserver.BaseServer.__init__(self, self.bind_address,
+                                         AgentHandler)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                   1)
+        self.socket.bind(self.bind_address)
+        self.socket.listen()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def get_request(self):
+        return self.socket.accept()
+
+    def shutdown_request(self, request):
+        request.close()
+
+    def server_close(self):
+        self.socket.close()
+
+    def reply(self, message):
+        if self.key is not None and message.get('key') != self.key:
+            return {'error': 'wrong agent key'}
+        if message['op'] == 'time':
+            return {'time': time.time()}
+        if message['op'] == 'schedule':
+            unknown = sorted({name for name, _, _ in message['commands']
+                              if name not in switches})
+            if unknown:
+                logging.error('Rejected switch commands for %s, not '
+                              'switches of this agent', ', '.join(unknown))
+                return {'error': 'switches %s not defined at agent'
+                        % ', '.join(unknown)}
+            with self.lock:
+                for name, onoff, stime in message['commands']:
+                    sw = switches[name]
+                    sw.schedule(sw, bool(onoff), stime)
+                airtime.commit()
+            logging.info('Received %s switch commands',
+                         len(message['commands']))
+            return {'scheduled': len(message['commands'])}
+        return {'error': 'unknown op %s' % message['op']}
+
+
+def fire(stime, action, argument):
+    # Execute an action at the wall clock time stime: the lane waited on
+    # the event loop until at most FINE_WAIT seconds are left, these are
+    # waited here in the executor thread on the monotonic clock (so a
+    # step of the wall clock doesn't stretch the wait), and at the
+    # deadline only the action itself is left.
+    # Returns the lateness of the action.
+    deadline = time.monotonic() + stime - time.time()
+    remaining = deadline - time.monotonic()
+    while remaining > 0:
+        time.sleep(remaining)
+        remaining = deadline - time.monotonic()
+    lateness = time.time() - stime
+    action(*argument)
+    return lateness
+
+
+class Lane:
+    # Execution lane of one physical bus: executes its actions one after
+    # the other in the order of (time, priority, sequence)
+    def __init__(self, name, dispatcher):
+        self.name = name
+        self.dispatcher = dispatcher
+        self.heap = []
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.max_depth = 0
+        self.fired = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+        # own worker thread, so a long action (e.g. a pulse) of this bus
+        # never delays the actions of the other lanes
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix=name)
+
+    def add(self, entry):
+        heapq.heappush(self.heap, entry)
+        self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.heap:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > FINE_WAIT:
+                # wait for the next action or a new earlier one, at most
+                # CLOCK_CHECK seconds to notice a step of the wall clock
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(),
+                                           min(delay - FINE_WAIT,
+                                               CLOCK_CHECK))
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            now = time.time()
+            depth = sum(1 for e in self.heap if e[0] <= now + FINE_WAIT)
+            self.max_depth = max(self.max_depth, depth)
+            metrics.set('caltimer_queue_depth', depth, lane=self.name)
+            entry = heapq.heappop(self.heap)
+            stime, priority, sequence, lane, action, argument, switch = entry
+            try:
+                lateness = await loop.run_in_executor(self.executor, fire,
+                                                      stime, action,
+                                                      argument)
+            except Exception as e:
+                lateness = time.time() - stime
+                logging.error('Switch action %s%s failed: %s',
+                              getattr(action, '__name__', action), argument,
+                              e)
+                metrics.inc('caltimer_errors_total',
+                            type=switch[0].type if switch else lane)
+            else:
+                if switch and switch[0].type != 'pulse':
+                    journal.record(switch[0].name, switch[1])
+            metrics.observe('caltimer_fire_lateness_seconds', lateness,
+                            lane=self.name)
+            self.fired += 1
+            self.lateness_sum += lateness
+            self.lateness_max = max(self.lateness_max, lateness)
+            self.dispatcher.done(sequence)
+
+
+class Dispatcher:
+    # Executes the scheduled switch actions with asyncio in a background
+    # thread. Each action belongs to a lane (physical bus): the actions of
+    # one lane are executed one after the other, different lanes run in
+    # parallel, so a slow action only delays the actions of its own bus.
+    # enterabs() and queue are compatible with sched.scheduler, the
+    # switch (switch, onoff) of an action is kept for the journal and the
+    # metrics.
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.lanes = {}
+        # sequence number: (time, priority, sequence, lane, action, argument)
+        self.entries = {}
+        self.sequence = 0
+        self.idle = threading.Condition()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='dispatcher', daemon=True)
+        self.thread.start()
+
+    def pulse(self, stime, sw, width):
+        # GPIO pulse of a pulse switch as one action, so its width doesn't
+        # depend on the lateness of the start
+        return self.enterabs(stime, 1, send_pulse, (sw.pin, width),
+                             lane=sw.lane, switch=(sw, None))
+
+    def enterabs(self, stime, priority, action, argument=(), lane='default',
+                 switch=None):
+        with self.idle:
+            self.sequence += 1
+            entry = (stime, priority, self.sequence, lane, action, argument,
+                     switch)
+            self.entries[self.sequence] = entry
+        self.loop.call_soon_threadsafe(self.add, entry)
+        return entry
+
+    def add(self, entry):
+        # runs in the event loop thread
+        name = entry[3]
+        if name not in self.lanes:
+            lane = Lane(name, self)
+            lane.task = self.loop.create_task(lane.run())
+            self.lanes[name] = lane
+        self.lanes[name].add(entry)
+
+    def done(self, sequence):
+        with self.idle:
+            del self.entries[sequence]
+            self.idle.notify_all()
+
+    @property
+    def queue(self):
+        with self.idle:
+            return sorted(self.entries.values(), key=lambda e: e[:3])
+
+    def run(self):
+        # wait until all scheduled actions are executed
+        with self.idle:
+            while self.entries:
+                self.idle.wait()
+
+    def log_stats(self):
+        # log and reset the lane statistics
+        for lane in list(self.lanes.values()):
+            if lane.fired:
+                logging.info('Lane %s: %s actions, max queue depth %s, '
+                             'lateness avg %.3f s, max %.3f s', lane.name,
+                             lane.fired, lane.max_depth,
+                             lane.lateness_sum / lane.fired,
+                             lane.lateness_max)
+                lane.fired = lane.max_depth = 0
+                lane.lateness_sum = lane.lateness_max = 0.0
+
+    async def cancel(self):
+        tasks = [lane.task for lane in self.lanes.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        # stop the dispatcher, pending actions are dropped
+        asyncio.run_coroutine_threadsafe(self.cancel(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        for lane in self.lanes.values():
+            lane.executor.shutdown()
+
+
+class Simulator:
+    # Stand-in for the Dispatcher of the --simulate mode: the scheduled
+    # actions are executed in time order against a virtual clock without
+    # waiting. The hardware calls of the actions go to the SimBackend,
+    # which writes them to the timeline. Like on the dispatcher, an
+    # action which is already due when it is scheduled is executed at
+    # once, so the virtual clock never goes back.
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.heap = []
+        self.sequence = 0
+        self.current = None
+        # virtual clock, set to the first interval by the caller
+        self.now = None
+        self.fired = 0
+        self.actions = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+
+    def enterabs(self, stime, priority, action, argument=(), lane='default',
+                 switch=None):
+        self.sequence += 1
+        entry = (stime, priority, self.sequence, lane, action, argument,
+                 switch)
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def pulse(self, stime, sw, width):
+        # the start and end of the pulse at their virtual times
+        self.enterabs(stime, 1, sw.transmit, argument=sw.on, lane=sw.lane,
+                      switch=(sw, True))
+        return self.enterabs(stime + width, 1, sw.transmit, argument=sw.off,
+                             lane=sw.lane, switch=(sw, False))
+
+    @property
+    def queue(self):
+        return sorted(self.heap)
+
+    def run(self, until=None):
+        # execute the actions scheduled before until (all if None)
+        while self.heap and (until is None or self.heap[0][0] < until):
+            stime, _, _, lane, action, argument, switch = heapq.heappop(
+                self.heap)
+            self.now = stime if self.now is None else max(stime, self.now)
+            lateness = self.now - stime
+            metrics.observe('caltimer_fire_lateness_seconds', lateness,
+                            lane=lane)
+            self.actions += 1
+            self.lateness_sum += lateness
+            self.lateness_max = max(self.lateness_max, lateness)
+            self.current = (lane, switch or (None, None))
+            recorded = self.fired
+            try:
+                action(*argument)
+            except Exception as e:
+                logging.error('Switch action %s%s failed: %s',
+                              getattr(action, '__name__', action), argument,
+                              e)
+            if self.fired == recorded:
+                # no hardware call, e.g. dummy switch
+                self.record(getattr(action, '__name__', action), 'dummy')
+        if until is not None:
+            # the next interval is scheduled at its start
+            self.now = until if self.now is None else max(until, self.now)
+
+    def record(self, command, kind=None, payload=()):
+        lane, (sw, onoff) = self.current
+        self.timeline.write('%s\t%s\t%s\t%s\t%s\n' % (
+            datetime.fromtimestamp(self.now).strftime(
+                '%Y-%m-%d %H:%M:%S.%f')[:-3],
+            sw.name if sw is not None else '-', switch_state.get(onoff, '-'),
+            lane, command))
+        self.fired += 1
+
+    def log_stats(self):
+        logging.info('Simulation: %s switch commands', self.fired)
+        if self.actions:
+            logging.info('Simulation: %s actions, lateness avg %.3f s, '
+                         'max %.3f s', self.actions,
+                         self.lateness_sum / self.actions, self.lateness_max)
+
+    def stop(self):
+        pass
+
+
+class TimelineCompiler(Simulator):
+    # Planner of the --compile mode: the actions are executed against the
+    # virtual clock like in the simulation, and the hardware calls are
+    # collected as fixed-width records (TIMELINE_RECORD) of a binary
+    # timeline file for caltimer_exec.py:
+    #   header (TIMELINE_HEADER): magic, version, records, JSON length
+    #   JSON: switch names, payloads (arguments of the hardware calls)
+    #         and the hardware settings, padded to 8 bytes
+    #   records sorted by time: time, switch id, state, kind, payload
+    # Commands of agent switches are pushed by the planner, not compiled.
+
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+        self.names = {}
+        self.payloads = {}
+
+    def record(self, command, kind=None, payload=()):
+        self.fired += 1
+        if kind not in TIMELINE_KINDS:
+            return
+        sw, onoff = self.current[1]
+        name = sw.name if sw is not None else '-'
+        payload = json.dumps(list(payload))
+        self.records.append((
+            self.now, self.names.setdefault(name, len(self.names)),
+            255 if onoff is None else int(onoff),
+            TIMELINE_KINDS.index(kind),
+            self.payloads.setdefault(payload, len(self.payloads))))
+
+    def log_stats(self):
+        logging.info('Compiled %s switch commands', len(self.records))
+
+    def write(self, filename, settings):
+        # replace the timeline file atomically, the executor keeps the
+        # mapping of the previous file
+        data = json.dumps({
+            'switches': list(self.names),
+            'payloads': [json.loads(p) for p in self.payloads],
+            'settings': settings}).encode()
+        data += b' ' * (-(TIMELINE_HEADER.size + len(data)) % 8)
+        self.records.sort()
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(TIMELINE_HEADER.pack(TIMELINE_MAGIC, TIMELINE_VERSION,
+                                         len(self.records), len(data)))
+            f.write(data)
+            for entry in self.records:
+                f.write(TIMELINE_RECORD.pack(*entry))
+        os.replace(filename + '.tmp', filename)
+        logging.info('Timeline %s written with %s switch commands',
+                     filename, len(self.records))
+
+
+class SimBackend:
+    # Recording hardware of the --simulate mode, used in place of
+    # RPi.GPIO, the RF transmitters (codesend or rpi-rf) and the nanoCULs:
+    # the switching calls are written to the timeline, all other calls
+    # (setup, cleanup, ...) do nothing. A transmitter has its kind and
+    # its GPIO pin, codesend command or serial port.
+    BCM = 'BCM'
+    OUT = 'OUT'
+
+    def __init__(self, simulator, kind=None, value=None):
+        self.simulator = simulator
+        self.kind = kind
+        self.value = value
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def output(self, pin, value):
+        # GPIO.output
+        self.simulator.record('GPIO %s %s' % (pin,
+                                              'HIGH' if value else 'LOW'),
+                              'gpio', (pin, int(value)))
+
+    def push(self, name, onoff, stime):
+        # AgentClient.push, the agent executes the command at stime
+        sw = switches[name]
+        self.simulator.enterabs(stime, 1, self.agent,
+                                sw.on if onoff else sw.off, lane=sw.lane,
+                                switch=(sw, onoff))
+
+    def agent(self, name, onoff):
+        self.simulator.record('agent', 'agent')
+
+    def send(self, code, protocol=None, pulselength=None, type=None):
+        # CulTransport.send(code) or TransmitWorker.send(code, ...)
+        if self.kind == 'kopp':
+            self.simulator.record('nanoCUL %s' % code, 'kopp',
+                                  (code, self.value))
+        elif self.kind == 'rpi-rf':
+            self.simulator.record('rpi-rf %s protocol %s pulse %s' % (
+                code, protocol, pulselength), 'rpi-rf',
+                (code, protocol, pulselength, int(self.value)))
+        else:
+            command = [self.value, str(code), str(protocol),
+                       str(pulselength)]
+            self.simulator.record(' '.join(command), 'codesend', command)
+
+
+class Switch:
+    # Switch definition of the ini file, compiled once at config load.
+    # 'on' and 'off' are the precomputed arguments of the bound 'transmit'
+    # function, 'schedule' adds the switch action to the scheduler lane
+    # of the bus used by the switch. RF and Kopp switches can be sent by
+    # any lane of 'transmitters', 'lane' is the first of them.
+    __slots__ = ('name', 'type', 'lane', 'on_code', 'off_code', 'protocol',
+                 'pulselength', 'airtime', 'pin', 'on_pulse', 'off_pulse',
+                 'transmit', 'on', 'off', 'schedule', 'transmitters')
+
+    def __init__(self, name, type, lane, transmit, on, off, on_code=None,
+                 off_code=None, protocol=None, pulselength=None, airtime=0.0,
+                 pin=None, on_pulse=None, off_pulse=None, schedule=None,
+                 transmitters=()):
+        self.name = name
+        self.type = type
+        self.lane = lane
+        self.transmit = transmit
+        self.on = on
+        self.off = off
+        self.on_code = on_code
+        self.off_code = off_code
+        self.protocol = protocol
+        self.pulselength = pulselength
+        self.airtime = airtime
+        self.pin = pin
+        self.on_pulse = on_pulse
+        self.off_pulse = off_pulse
+        self.schedule = schedule or schedule_switch
+        self.transmitters = transmitters
+
+
+def schedule_switch(sw, onoff, stime):
+    logging.info('<<< Schedule %s %s code %s for switch %s at time %s',
+                 sw.type, switch_state[onoff],
+                 sw.on_code if onoff else sw.off_code, sw.name,
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)))
+    s.enterabs(stime, 1, sw.transmit, argument=sw.on if onoff else sw.off,
+               lane=sw.lane, switch=(sw, onoff))
+
+
+def schedule_pulse(sw, onoff, stime):
+    logging.info(
+        '<<< Schedule GPIO %s pulse %s at %s', sw.pin,
+        onoff, time.strftime('%H:%M:%S', time.localtime(stime)))
+    s.pulse(stime, sw, sw.on_pulse if onoff else sw.off_pulse)
+
+
+def schedule_rf(sw, onoff, stime):
+    logging.info('<<< Schedule %s %s code %s for switch %s at time %s',
+                 sw.type, switch_state[onoff],
+                 sw.on_code if onoff else sw.off_code, sw.name,
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)))
+    airtime.add(sw, onoff, stime)
+
+
+def schedule_agent(sw, onoff, stime):
+    logging.info('<<< Schedule %s for switch %s at agent %s at time %s',
+                 switch_state[onoff], sw.name, sw.lane[6:],
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)))
+    sw.transmit(*(sw.on if onoff else sw.off), stime)
+
+
+class AirtimePlanner:
+    # Plans the RF and Kopp transmissions of a scheduler interval: codes
+    # which would overlap on air are grouped into a burst per bus (RF
+    # transmitters or nanoCULs). Each code is sent by the transmitter of
+    # its switch which is free first (the less loaded one on a tie, failed
+    # ones only if there is no other) and spaced by its on-air duration
+    # plus rf_gap on that transmitter. A code planned several times for
+    # the same switch, state and time (e.g. by different events) is sent
+    # only once; the second_switch repeat is a code of its own, which is
+    # queued after the codes planned before it. The codes of a failed
+    # transmitter are planned again by the transmitter threads.
+
+    def __init__(self, gap):
+        self.gap = gap
+        self.pending = []
+        # lane: end of the last planned transmission
+        self.end = {}
+        self.lock = threading.Lock()
+
+    def add(self, sw, onoff, stime):
+        self.pending.append((stime, len(self.pending), sw, onoff))
+
+    def commit(self):
+        # Add the planned transmissions to the scheduler
+        self.pending.sort(key=lambda p: p[:2])
+        bursts = {}
+        for stime, _, sw, onoff in self.pending:
+            bus = sw.lane.split()[0]
+            burst = bursts.get(bus)
+            if burst is None or stime >= self.busy(bus):
+                self.log_burst(burst)
+                # start, codes, duplicates, sent codes, codes per lane
+                burst = bursts[bus] = [stime, 0, 0, set(), {}]
+            if (sw.name, onoff, stime) in burst[3]:
+                burst[2] += 1
+                continue
+            burst[3].add((sw.name, onoff, stime))
+            burst[1] += 1
+            lanes = [lane for lane in sw.transmitters
+                     if not transmitter_down(lane)] or sw.transmitters
+            lane = min(lanes, key=lambda lane: (
+                max(stime, self.end.get(lane, 0.0)), burst[4].get(lane, 0)))
+            burst[4][lane] = burst[4].get(lane, 0) + 1
+            self.enter(sw, onoff, lane, stime)
+        for burst in bursts.values():
+            self.log_burst(burst)
+        self.pending = []
+
+    def enter(self, sw, onoff, lane, stime):
+        # schedule the code on lane after its last planned transmission
+        with self.lock:
+            slot = max(stime, self.end.get(lane, 0.0))
+            self.end[lane] = slot + sw.airtime + (self.gap if sw.airtime
+                                                  else 0.0)
+        try:
+            s.enterabs(slot, 1, transmitters[lane].send,
+                       argument=sw.on if onoff else sw.off, lane=lane,
+                       switch=(sw, onoff))
+        except RuntimeError:
+            # the dispatcher is already stopped (failover at the end)
+            transmitters[lane].send(*(sw.on if onoff else sw.off))
+
+    def resend(self, sw, onoff, failed):
+        # Plan the code of the failed transmitter lane again on the other
+        # transmitter of sw which is free first.
+        # Returns that lane, None if there is none.
+        lanes = [lane for lane in sw.transmitters
+                 if lane != failed and not transmitter_down(lane)]
+        if not lanes:
+            return None
+        now = time.time()
+        lane = min(lanes, key=lambda lane: max(now, self.end.get(lane, 0.0)))
+        self.enter(sw, onoff, lane, now)
+        return lane
+
+    def busy(self, bus):
+        # end of the last planned transmission of the lanes of bus
+        return max((end for lane, end in self.end.items()
+                    if lane.split()[0] == bus), default=0.0)
+
+    def log_burst(self, burst):
+        if burst is not None and (burst[1] > 1 or burst[2]):
+            logging.info('RF burst at %s: %s codes on %s transmitters, %s '
+                         'duplicates removed, burst length %.2f s',
+                         time.strftime('%H:%M:%S', time.localtime(burst[0])),
+                         burst[1], len(burst[4]), burst[2],
+                         max(self.end[lane] for lane in burst[4])
+                         - burst[0])
+
+
+class StateJournal:
+    # Last commanded state of each switch. Every change is appended to a
+    # journal file (time, switch, 1/0 per line), so the state survives a
+    # restart; the file is rewritten with one line per switch when it
+    # grew by COMPACT lines. Without filename the state is kept in memory.
+    # The commands are journaled by the dispatcher and the lane threads.
+    COMPACT = 1000
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # reentrant, record() compacts the file while holding it
+        self.lock = threading.RLock()
+        # switch name: (state, time)
+        self.state = {}
+        # switch name: last planned state
+        self.planned = {}
+        self.lines = 0
+        self.file = None
+        if filename is None:
+            return
+        try:
+            with open(filename) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 3:
+                        self.state[fields[1]] = (fields[2] == '1',
+                                                 float(fields[0]))
+                        self.lines += 1
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.error('Unable to read switch journal %s: %s', filename,
+                          e)
+        self.planned = {name: state for name, (state, _) in
+                        self.state.items()}
+        try:
+            if self.lines > len(self.state) + self.COMPACT:
+                self.compact()
+            else:
+                self.file = open(filename, 'a')
+        except OSError as e:
+            logging.error('Unable to write switch journal %s: %s', filename,
+                          e)
+
+    def get(self, name):
+        return self.state.get(name, (None,))[0]
+
+    def record(self, name, onoff, stime=None):
+        # journal an executed switch command if it changed the state
+        with self.lock:
+            if self.get(name) == onoff:
+                return
+            stime = time.time() if stime is None else stime
+            self.state[name] = (onoff, stime)
+            if self.file is None:
+                return
+            try:
+                self.file.write('%.3f\t%s\t%d\n' % (stime, name, onoff))
+                self.file.flush()
+                self.lines += 1
+                if self.lines > len(self.state) + self.COMPACT:
+                    self.compact()
+            except OSError as e:
+                logging.error('Unable to write switch journal %s: %s',
+                              self.filename, e)
+
+    def compact(self):
+        # replace the journal by the current state of each switch
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            with open(self.filename + '.tmp', 'w') as f:
+                for name, (onoff, stime) in self.state.items():
+                    f.write('%.3f\t%s\t%d\n' % (stime, name, onoff))
+            os.replace(self.filename + '.tmp', self.filename)
+            self.lines = len(self.state)
+            self.file = open(self.filename, 'a')
+        logging.debug('Compacted switch journal %s', self.filename)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+journal = StateJournal()
+
+
+def plan_command(sw, onoff, stime, window=None):
+    # Add a switch command of a calendar event to the plan of the interval,
+    # window is the time range of its random offset
+    plan.append((stime, len(plan), sw, onoff, window or (stime, stime)))
+
+
+def commit_plan():
+    # Schedule the planned switch commands in time order. A command
+    # which doesn't change the last commanded state of its switch (e.g.
+    # of overlapping events) is dropped, the others are scheduled with
+    # their repeat after second_switch seconds. Pulses are always sent.
+    plan.sort(key=lambda c: c[:2])
+    suppressed = 0
+    for stime, _, sw, onoff, _ in plan:
+        if sw.type != 'pulse':
+            if journal.planned.get(sw.name) == onoff:
+                suppressed += 1
+                continue
+            journal.planned[sw.name] = onoff
+        sw.schedule(sw, onoff, stime)
+        if second_switch > 0:
+            sw.schedule(sw, onoff, stime + second_switch)
+    if suppressed:
+        logging.info('%s switch commands suppressed, the switches are '
+                     'already in that state', suppressed)
+    metrics.inc('caltimer_suppressed_total', suppressed)
+    plan.clear()
+
+
+def rf_transmit(name, section, code, protocol, pulselength, type):
+    # Create the switch for an RF code via codesend (commands of rf433) or
+    # rpi-rf (transmitters at the pins of gpio), both are sent by the
+    # transmit workers
+    if protocol not in rf_protocols:
+        raise ValueError('unknown protocol %s' % protocol)
+    # on-air duration of the code: repeats x (sync + 24 bits) x pulse length
+    sync, bit = rf_protocols[protocol]
+    airtime = (int(section.get('rf_repeat', '10')) * (sync + 24 * bit)
+               * pulselength / 1e6)
+    if section['rf_code'] == "rf433":
+        lanes = use_transmitters('rf433', config_list(section, 'rf433'))
+    elif section['rf_code'] == "rpi-rf":
+        lanes = use_transmitters('rpi-rf', config_list(section, 'gpio'))
     else:
-        logging.error(
-            'rf_switch undefined rf_code for switch %s, check ini file!',
-            switch)
+        raise ValueError('undefined rf_code "%s"' % section['rf_code'])
+    if not lanes:
+        raise ValueError('no transmitter for rf_code "%s"'
+                         % section['rf_code'])
+    return Switch(name, type, lanes[0], transmitters[lanes[0]].send,
+                  (code[0], protocol, pulselength, type),
+                  (code[1], protocol, pulselength, type),
+                  code[0], code[1], protocol, pulselength, airtime,
+                  schedule=schedule_rf, transmitters=lanes)
+
+
+def rf_switch(name, section):
+    return rf_transmit(
+        name, section, (int(section['oncode']), int(section['offcode'])),
+        int(section['protocol']), int(section['pulselength']), 'rf')
 
 
-def rf_comag(switch, onoff, stime):
+def rf_comag(name, section):
     # Comag code calculation:
     # switch OFF = "0" = binary "01" = tri-state "F"
     # switch ON  = "1" = binary "00" = tri-state "0"
@@ -107,40 +1364,27 @@ def rf_comag(switch, onoff, stime):
     # Example:
     # Channel   Socket    ON/OFF
     # 0 1 0 0 0 0 0 1 1 0 10/01
-
-    # Create binary code
-    bincode = config[switch]['system'] + config[switch]['receiver']
-    if onoff:
-        bincode += '10'
-    else:
-        bincode += '01'
-    logging.debug('*** Comag binary code = %s', bincode)
-    # translate
-    sendcode = 0
-    for c in bincode:
-        sendcode = sendcode << 2
-        if c == "0":
-            sendcode = sendcode | 1
-    logging.debug('*** Comag sendcode = %s', '{:08b}'.format(sendcode))
-    logging.info('<<< rf_comag schedule to send %s code %s for switch %s at '
-                 'time %s via %s',
-                 switch_state[onoff], sendcode, switch,
-                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)),
-                 config[switch]['rf_code'])
-    if config[switch]['rf_code'] == "rf433":
-        s.enterabs(stime, 1, subprocess.call,
-                   argument=([config['DEFAULT']['rf433'],
-                              str(sendcode), "1", str(pulse_comag)],))
-    elif config[switch]['rf_code'] == "rpi-rf":
-        s.enterabs(stime, 1, rfdevice.tx_code,
-                   argument=(int(sendcode), 1, pulse_comag))
-    else:
-        logging.error(
-            'rf_comag undefined rf_code for switch %s, check ini file!',
-            switch)
-
-
-def rf_zap(switch, onoff, stime):
+    codes = []
+    for onoff in ('10', '01'):
+        # Create binary code
+        bincode = section['system'] + section['receiver'] + onoff
+        if len(bincode) != 12 or set(bincode) - set('01'):
+            raise ValueError('system and receiver must be 5 binary digits')
+        logging.debug('*** Comag binary code = %s', bincode)
+        # translate
+        sendcode = 0
+        for c in bincode:
+            sendcode = sendcode << 2
+            if c == "0":
+                sendcode = sendcode | 1
+        logging.debug('*** Comag sendcode = %s', '{:08b}'.format(sendcode))
+        codes.append(sendcode)
+    return rf_transmit(name, section, codes, 1,
+                       int(section.get('pulselength', pulse_comag)),
+                       'comag')
+
+
+def rf_zap(name, section):
     # ZAP/REV code calculation:_
     # tristate
     #   0 = binary "00"
@@ -159,17 +1403,24 @@ def rf_zap(switch, onoff, stime):
     # 'channel'  : tri-state
     # 'zap_base' : tri-state base for the key part
     # 'key'      : decimal number of the receiver
+    if len(section['channel']) != 5 or set(section['channel']) - set('01F'):
+        raise ValueError('channel must be 5 tri-state digits 0, 1 or F')
+    if len(section['zap_base']) != 5 or set(section['zap_base']) - set('01F'):
+        raise ValueError('zap_base must be 5 tri-state digits 0, 1 or F')
+    key = int(section['key'])
+    if not 1 <= key <= 5:
+        raise ValueError('key must be 1-5')
 
     # Create binary code
     sendcode = 0
-    for c in config[switch]['channel']:
+    for c in section['channel']:
         sendcode = sendcode << 2
         if c == '1':
             sendcode = sendcode | 3
         elif c == 'F':
             sendcode = sendcode | 1
-    key_code = list(config[switch]['zap_base'])
-    key_code[5-int(config[switch]['key'])] = "1"
+    key_code = list(section['zap_base'])
+    key_code[5-key] = "1"
     for c in key_code:
         sendcode = sendcode << 2
         if c[0] == '1':
@@ -177,30 +1428,13 @@ def rf_zap(switch, onoff, stime):
         elif c[0] == 'F':
             sendcode = sendcode | 1
     sendcode = sendcode << 4
-    if onoff:
-        sendcode = sendcode | 3
-    else:
-        sendcode = sendcode | 12
-    logging.debug('*** ZAP sendcode = %s', '{:08b}'.format(sendcode))
-    logging.info('<<< rf_zap schedule to send %s code %s for switch %s at '
-                 'time %s via %s',
-                 switch_state[onoff], sendcode, switch,
-                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)),
-                 config[switch]['rf_code'])
-    if config[switch]['rf_code'] == "rf433":
-        s.enterabs(
-            stime, 1, subprocess.call,
-            argument=([config['DEFAULT']['rf433'],
-                       str(sendcode), "1", str(pulse_zap)],))
-    elif config[switch]['rf_code'] == "rpi-rf":
-        s.enterabs(stime, 1, rfdevice.tx_code,
-                   argument=(sendcode, 1, pulse_zap))
-    else:
-        logging.error(
-            'rf_zap undefined rf_code for switch %s, check ini file!', switch)
+    codes = (sendcode | 3, sendcode | 12)
+    logging.debug('*** ZAP sendcode = %s', '{:08b}'.format(codes[0]))
+    return rf_transmit(name, section, codes, 1,
+                       int(section.get('zap_pulse', pulse_zap)), 'zap')
 
 
-def rf_kopp(switch, onoff, stime):
+def rf_kopp(name, section):
     # Kopp code example
     #
     # kt004B130300100N
@@ -209,67 +1443,176 @@ def rf_kopp(switch, onoff, stime):
     # ||||++++++-------- Transmitter Code 1 + 2
     # ||++-------------- Key code on/off
     # ++---------------- kt = nanocul command for Kopp transmit
-
-    sendcode = 'kt'
-    if onoff:
-        if config.has_option(switch, 'key_on'):
-            sendcode += config[switch]['key_on']
-        else:
-            # calculate key_on from key_off by adding 0x10
-            sendcode += format(int(config[switch]['key_off'], base=16)+16, 'X')
+    key_off = section['key_off']
+    if 'key_on' in section:
+        key_on = section['key_on']
     else:
-        sendcode += config[switch]['key_off']
-    sendcode += (config[switch]['transmit_1']
-                 + config[switch]['transmit_2']
-                 + kopp_time + 'N')
-    s.enterabs(stime, 1, send_ser, argument=(sendcode,))
-    logging.info('<<< rf_kopp schedule to send %s code %s to nanocul for '
-                 'switch % s at time %s',
-                 switch_state[onoff], sendcode, switch,
-                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stime)))
-
-
-def gpio_switch(switch, onoff, stime):
-    # Set the pin to output (just to be sure...)
-    try:
-        GPIO.setup(int(config[switch]['pin']), GPIO.OUT)
-    except:
-        logging.error('GPIO setup error for pin %d', config[switch]['pin'])
+        # calculate key_on from key_off by adding 0x10
+        key_on = format(int(key_off, base=16)+16, 'X')
+    for code in (key_on, key_off, section['transmit_1'],
+                 section['transmit_2']):
+        int(code, base=16)
+    code = (section['transmit_1'] + section['transmit_2']
+            + section.get('kopp_time', kopp_time).zfill(5) + 'N')
+    lanes = use_transmitters('kopp', config_list(section, 'ser_port'))
+    if not lanes:
+        raise ValueError('no ser_port of the nanoCUL')
+    return Switch(name, 'kopp', lanes[0], transmitters[lanes[0]].send,
+                  ('kt' + key_on + code,), ('kt' + key_off + code,),
+                  'kt' + key_on + code, 'kt' + key_off + code,
+                  schedule=schedule_rf, transmitters=lanes)
+
+
+def gpio_switch(name, section):
+    pin = int(section['pin'])
+    use_hardware('gpio')
+    # Set the pin to output
+    GPIO.setup(pin, GPIO.OUT)
     # Can directly use the Boolean variable onoff since True=1=GPIO.HIGH
-    s.enterabs(stime, 1, GPIO.output,
-               argument=(int(config[switch]['pin']), onoff))
-    logging.info('<<< Schedule GPIO %s %s at %s', config[switch]['pin'],
-                 onoff, time.strftime('%H:%M:%S', time.localtime(stime)))
-
-
-def gpio_pulse(switch, onoff, stime):
-    # Set the pin to output (just to be sure...)
+    return Switch(name, 'gpio', 'gpio %s' % pin, GPIO.output, (pin, True),
+                  (pin, False), True, False, pin=pin)
+
+
+def gpio_pulse(name, section):
+    pin = int(section['pin'])
+    use_hardware('gpio')
+    # Set the pin to output
+    GPIO.setup(pin, GPIO.OUT)
+    # Get the duration of the pulses
+    pulses = []
+    for onoff in ('on', 'off'):
+        pulsetime = float(section[onoff])
+        # Check for maximum pulse length, e.g. 10s (configured in config.ini)
+        if pulsetime > float(section['max_pulse']):
+            logging.error(
+                'The pulse duration of %s s is too long, setting to max= %s',
+                pulsetime, section['max_pulse'])
+            pulsetime = float(section['max_pulse'])
+        pulses.append(pulsetime)
+    return Switch(name, 'pulse', 'gpio %s' % pin, GPIO.output, (pin, 1),
+                  (pin, 0), pin=pin, on_pulse=pulses[0], off_pulse=pulses[1],
+                  schedule=schedule_pulse)
+
+
+def send_pulse(pin, width):
+    # GPIO pulse, the width is timed by the monotonic clock of sleep()
+    GPIO.output(pin, 1)
     try:
-        GPIO.setup(int(config[switch]['pin']), GPIO.OUT)
-    except:
-        logging.error('GPIO setup error for pin %d', config[switch]['pin'])
-# Get the duration of the pulse
-    if onoff:
-        pulsetime = float(config[switch]['on'])
-    else:
-        pulsetime = float(config[switch]['off'])
-# Check for maximum pulse length, e.g. 10s (configured in config.ini)
-    if pulsetime > float(config['DEFAULT']['max_pulse']):
-        logging.error(
-            'The pulse duration of %s s is too long, setting to max= %s',
-            pulsetime, config['DEFAULT']['max_pulse'])
-        pulsetime = float(config['DEFAULT']['max_pulse'])
-    logging.info(
-        '<<< Schedule GPIO %s pulse %s at %s', config[switch]['pin'],
-        onoff, time.strftime('%H:%M:%S', time.localtime(stime)))
-    s.enterabs(stime, 1, GPIO.output, argument=(int(config[switch]['pin']), 1))
-    s.enterabs(stime+pulsetime, 1, GPIO.output,
-               argument=(int(config[switch]['pin']), 0))
-
-
-def dummy_switch(switch, onoff, stime):
-    s.enterabs(stime, 1, logging.warning,
-               argument=('Dummy event action: %s', onoff))
+        time.sleep(width)
+    finally:
+        GPIO.output(pin, 0)
+
+
+def dummy_switch(name, section):
+    return Switch(name, 'dummy', 'dummy', logging.warning,
+                  ('Dummy event action: %s %s', name, 'ON'),
+                  ('Dummy event action: %s %s', name, 'OFF'))
+
+
+def agent_switch(name, section):
+    # Switch of a remote agent, the commands are pushed to the agent
+    use_hardware('agent')
+    return Switch(name, 'agent', 'agent %s' % section['agent'],
+                  agents[section['agent']].push, (name, True),
+                  (name, False), schedule=schedule_agent)
+
+
+# Switch backends: type: compile(name, section) returns the compiled
+# Switch. A backend opens its hardware with use_hardware() when its first
+# switch is compiled. Third-party backends are added by the module of
+# the switch option 'module' with register_backend().
+backends = {}
+
+
+def register_backend(type, compile):
+    backends[type] = compile
+
+
+register_backend('rf', rf_switch)
+register_backend('comag', rf_comag)
+register_backend('zap', rf_zap)
+register_backend('kopp', rf_kopp)
+register_backend('gpio', gpio_switch)
+register_backend('pulse', gpio_pulse)
+register_backend('dummy', dummy_switch)
+register_backend('agent', agent_switch)
+
+
+def compile_switches(agent=None):
+    # Create the switch table of all switch sections of the ini file and
+    # the groups of switches (sections with 'members').
+    # The agent named 'agent' only uses its own switches (the ones with
+    # this 'agent' option), the other switches belong to the planner.
+    # Returns False if a switch definition is incorrect.
+    global switches, groups
+    switches = {}
+    ok = True
+    for name in config.sections():
+        if name in ('LOGGING', 'CALENDAR'):
+            continue
+        section = config[name]
+        if 'members' in section:
+            continue
+        if agent is not None:
+            if section.get('agent') != agent:
+                # switch of the planner or of another agent
+                continue
+        elif 'agent' in section:
+            # switch of a remote agent, its type is used by the agent
+            section = dict(section, type='agent')
+        if section.get('type') not in backends and 'module' in section:
+            # third-party backend
+            try:
+                importlib.import_module(section['module'])
+            except ImportError as e:
+                logging.error('Unable to load switch module %s: %s',
+                              section['module'], e)
+        if section.get('type') not in backends:
+            logging.error('Switch "%s" uses undefined type "%s", check ini '
+                          'file.', name, section.get('type'))
+            ok = False
+            continue
+        try:
+            switches[name] = backends[section['type']](name, section)
+        except ImportError as e:
+            logging.error('Switch "%s" needs a missing library (%s).', name,
+                          e)
+            ok = False
+        except (KeyError, ValueError, RuntimeError) as e:
+            logging.error('Switch "%s" definition is incorrect (%s), check '
+                          'ini file.', name, e)
+            ok = False
+    groups = {}
+    for name in config.sections():
+        if 'members' in config[name] and name not in ('LOGGING', 'CALENDAR'):
+            try:
+                groups[name] = group_members(name, agent, ())
+            except ValueError as e:
+                logging.error('Group "%s" definition is incorrect (%s), '
+                              'check ini file.', name, e)
+                ok = False
+    logging.debug('Compiled %s switches', len(switches))
+    return ok
+
+
+def group_members(name, agent, parents):
+    # Switches of a group section, members can also be groups. On an
+    # agent, the switches of the planner and other agents are left out.
+    members = []
+    for member in re.split(r'[,\n]', config[name]['members']):
+        member = member.strip()
+        if not member:
+            continue
+        if member in parents or member == name:
+            raise ValueError('group %s contains itself' % member)
+        if member in switches:
+            members.append(switches[member])
+        elif member in config and 'members' in config[member]:
+            members += group_members(member, agent, parents + (name,))
+        elif agent is None or member not in config:
+            raise ValueError('unknown member %s' % member)
+    # a switch in several member groups is switched once
+    return list({sw.name: sw for sw in members}.values())
 
 
 def configure_logging(log_arg, update, file):
@@ -353,7 +1696,7 @@ def configure_logging(log_arg, update, file):
 
 
 def get_location(file, address):
-    response = requests.get(
+    response = http_session().get(
         'https://maps.googleapis.com/maps/api/geocode/json?address='+address)
     resp_json_payload = response.json()
     latitude = resp_json_payload['results'][0]['geometry']['location']['lat']
@@ -371,63 +1714,1590 @@ def update_ini(file):
         config.write(configfile)
 
 
-def get_sun(offset, m_rise, m_set):
-    # calculate sunrise and sunset times for specified location
-    ro = SunriseSunset(
-        datetime.now(), latitude=float(config['CALENDAR']['latitude']),
-        longitude=float(config['CALENDAR']['longitude']),
-        localOffset=offset)
-    rise_time, set_time = ro.calculate()
+def calculate_sun(first, days, latitude, longitude):
+    # Calculate sunrise and sunset for the days first..first+days (date
+    # ordinals) in one vectorized pass, using the NOAA solar equations.
+    # Returns an array (days, 2) with the UTC timestamps of rise and set.
+    rad = numpy.radians
+    deg = numpy.degrees
+    ordinals = numpy.arange(first, first + days, dtype=numpy.float64)
+    # Julian century of the solar noon
+    jd = ordinals + 1721424.5 + 0.5 - longitude / 360
+    t = (jd - 2451545) / 36525
+    mean_long = (280.46646 + t * (36000.76983 + t * 0.0003032)) % 360
+    anomaly = 357.52911 + t * (35999.05029 - 0.0001537 * t)
+    eccent = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+    center = (numpy.sin(rad(anomaly))
+              * (1.914602 - t * (0.004817 + 0.000014 * t))
+              + numpy.sin(rad(2 * anomaly)) * (0.019993 - 0.000101 * t)
+              + numpy.sin(rad(3 * anomaly)) * 0.000289)
+    omega = rad(125.04 - 1934.136 * t)
+    app_long = mean_long + center - 0.00569 - 0.00478 * numpy.sin(omega)
+    obliq = (23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813)))
+                   / 60) / 60 + 0.00256 * numpy.cos(omega))
+    decl = numpy.arcsin(numpy.sin(rad(obliq)) * numpy.sin(rad(app_long)))
+    y = numpy.tan(rad(obliq / 2)) ** 2
+    eq_time = 4 * deg(
+        y * numpy.sin(2 * rad(mean_long))
+        - 2 * eccent * numpy.sin(rad(anomaly))
+        + 4 * eccent * y * numpy.sin(rad(anomaly))
+        * numpy.cos(2 * rad(mean_long))
+        - 0.5 * y * y * numpy.sin(4 * rad(mean_long))
+        - 1.25 * eccent * eccent * numpy.sin(2 * rad(anomaly)))
+    # hour angle of sunrise, limited for polar day and night
+    lat = rad(latitude)
+    hour_angle = deg(numpy.arccos(numpy.clip(
+        numpy.cos(rad(90.833)) / (numpy.cos(lat) * numpy.cos(decl))
+        - numpy.tan(lat) * numpy.tan(decl), -1, 1)))
+    # minutes after midnight UTC
+    noon = 720 - 4 * longitude - eq_time
+    midnight = (ordinals - date(1970, 1, 1).toordinal()) * 86400
+    table = numpy.empty((days, 2))
+    table[:, 0] = midnight + (noon - 4 * hour_angle) * 60
+    table[:, 1] = midnight + (noon + 4 * hour_angle) * 60
+    return table
+
+
+class SunTable:
+    # Sunrise and sunset of two years (starting January 1st of the current
+    # year) for one location, saved as memory-mapped file. The table is
+    # only calculated again if the coordinates change or a date outside of
+    # the table is requested.
+    # File layout (float64): latitude, longitude, first day, days, table
+    HEADER = 4
+    DAYS = 731
+
+    def __init__(self, filename, latitude, longitude):
+        self.filename = filename
+        self.latitude = latitude
+        self.longitude = longitude
+        self.first = None
+        self.table = None
+
+    def load(self, day):
+        # Open the table file if it matches, else calculate it
+        try:
+            data = numpy.memmap(self.filename, dtype=numpy.float64, mode='r')
+            first, days = int(data[2]), int(data[3])
+            if (data[0] == self.latitude and data[1] == self.longitude
+                    and first <= day.toordinal() < first + days
+                    and len(data) == self.HEADER + 2 * days):
+                self.first = first
+                self.table = data[self.HEADER:].reshape((days, 2))
+                return
+        except (OSError, ValueError, IndexError):
+            pass
+        first = date(day.year, 1, 1).toordinal()
+        logging.info('Calculate sun table for %s days from %s', self.DAYS,
+                     date.fromordinal(first))
+        table = calculate_sun(first, self.DAYS, self.latitude,
+                              self.longitude)
+        self.first = first
+        self.table = table
+        try:
+            data = numpy.memmap(self.filename + '.tmp', dtype=numpy.float64,
+                                mode='w+', shape=(self.HEADER + table.size,))
+            data[:self.HEADER] = (self.latitude, self.longitude, first,
+                                  self.DAYS)
+            data[self.HEADER:] = table.ravel()
+            data.flush()
+            del data
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            logging.warning('Unable to save sun table %s: %s',
+                            self.filename, e)
+
+    def get(self, day):
+        # Return the sunrise and sunset timestamps of the date day
+        if self.table is None or not (
+                0 <= day.toordinal() - self.first < len(self.table)):
+            self.load(day)
+        rise, sunset = self.table[day.toordinal() - self.first]
+        return float(rise), float(sunset)
+
+
+def get_sun(day, m_rise, m_set):
+    # calculate sunrise and sunset times of the date day
+    # for specified location
+    global sun_table, numpy
+    latitude = float(config['CALENDAR']['latitude'])
+    longitude = float(config['CALENDAR']['longitude'])
+    if numpy is None:
+        try:
+            numpy = importlib.import_module('numpy')
+        except ImportError:
+            numpy = False
+    if numpy:
+        if (sun_table is None or sun_table.latitude != latitude
+                or sun_table.longitude != longitude):
+            sun_table = SunTable(
+                config['CALENDAR'].get('sun_table',
+                                       '/var/cache/caltimer/sun.dat'),
+                latitude, longitude)
+        rise, sunset = sun_table.get(day)
+        rise_time = datetime.fromtimestamp(rise)
+        set_time = datetime.fromtimestamp(sunset)
+    else:
+        # NumPy not available, calculate the single day
+        SunriseSunset = importlib.import_module(
+            'sunrise_sunset').SunriseSunset
+        noon = datetime.combine(day, datetime.min.time()).replace(hour=12)
+        ro = SunriseSunset(
+            noon, latitude=latitude, longitude=longitude,
+            localOffset=noon.astimezone().utcoffset().total_seconds() / 3600)
+        rise_time, set_time = ro.calculate()
     # overwrite sun times for test purposes
     if m_rise is not None:
-        rise_time = datetime.strptime(str(date.today())+" "+m_rise,
+        rise_time = datetime.strptime(str(day)+" "+m_rise,
                                       "%Y-%m-%d %H:%M")
     if m_set is not None:
-        # temp_time = str(date.today()) + " " + args.sun_set
-        set_time = datetime.strptime(str(date.today())+" "+m_set,
+        set_time = datetime.strptime(str(day)+" "+m_set,
                                      "%Y-%m-%d %H:%M")
-    logging.info('Sunrise %s, sunset %s', rise_time, set_time)
+    logging.debug('Sunrise %s, sunset %s', rise_time, set_time)
     return rise_time, set_time
 
 
+def sun_days(args):
+    # sun(day) for the events of an interval, calculated once per day
+    days = {}
+
+    def sun(day):
+        if day not in days:
+            days[day] = get_sun(day, args.sun_rise, args.sun_set)
+        return days[day]
+    return sun
+
+
 def switch_defined(switch):
-    if not config.has_section(switch):
+    if switch not in switches and switch not in groups:
         logging.error(
             '>>> Event has an undefined RF-switch "%s"'
             ', skipping this event.',
             switch)
         return False
-    elif not config[switch]['type'] in switch_type:
-        logging.error(
-            '>>> RF-switch "%s" uses undefined type "%s" , '
-            'check ini file. Skipping this event.',
-            switch, config[switch]['type'])
-        return False
     return True
 
 
-#############################################################
-# MAIN                                                      #
-#############################################################
-def main():
+def local_time(value):
+    # Convert a date or datetime of the calendar to a naive local datetime
+    if not isinstance(value, datetime):
+        return datetime.combine(value, datetime.min.time())
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def event_occurrences(e, dt_start, dt_end):
+    # Return the (start, end) times of all occurrences of the vevent e
+    # which overlap with the time interval dt_start..dt_end.
+    # Recurrences are expanded with RRULE, RDATE and EXDATE, the end time
+    # can be on another day than the start time.
+    start = e.dtstart.value
+    if hasattr(e, 'dtend'):
+        duration = local_time(e.dtend.value) - local_time(start)
+    elif hasattr(e, 'duration'):
+        duration = e.duration.value
+    else:
+        duration = timedelta(0)
+    rruleset = e.getrruleset(addRDate=True)
+    if rruleset is None:
+        starts = [start]
+    else:
+        lower = dt_start - duration
+        upper = dt_end
+        if isinstance(start, datetime) and start.tzinfo is not None:
+            lower = lower.astimezone()
+            upper = upper.astimezone()
+        starts = rruleset.between(lower, upper, inc=True)
+    occurrences = []
+    for occ_start in starts:
+        occ_start = local_time(occ_start)
+        occ_end = occ_start + duration
+        if occ_start < dt_end and occ_end > dt_start:
+            occurrences.append((occ_start, occ_end))
+    return occurrences
+
+
+def expand_object(vevents, dt_start, dt_end):
+    # Expand the VEVENT components of one calendar object to the
+    # occurrences which overlap with the time interval dt_start..dt_end.
+    # Instances of a recurring event which are overridden by a component
+    # with RECURRENCE-ID are replaced by that component.
+    # Returns a list of (component index, start, end)
+    overrides = set()
+    for e in vevents:
+        if hasattr(e, 'recurrence_id'):
+            overrides.add((getattr(e, 'uid', None) and e.uid.value,
+                           local_time(e.recurrence_id.value)))
+    occurrences = []
+    for component, e in enumerate(vevents):
+        uid = getattr(e, 'uid', None) and e.uid.value
+        master = not hasattr(e, 'recurrence_id')
+        for e_start_dt, e_end_dt in event_occurrences(e, dt_start, dt_end):
+            if master and (uid, e_start_dt) in overrides:
+                continue
+            occurrences.append((component, e_start_dt, e_end_dt))
+    return occurrences
+
+
+class OccurrenceIndex:
+    # Event occurrences as arrays sorted by the start time plus a centered
+    # interval tree of them. A window query finds the occurrences which
+    # start in the window by binary search and the ones which started
+    # before and still run by a stabbing query of the tree, in
+    # O(log n + k) also with a few very long (e.g. multi-day) occurrences.
+
+    def __init__(self, occurrences):
+        # occurrences: list of (start timestamp, end timestamp, item)
+        occurrences.sort(key=lambda o: o[0])
+        self.starts = [o[0] for o in occurrences]
+        self.ends = [o[1] for o in occurrences]
+        self.items = [o[2] for o in occurrences]
+        self.tree = self.build(list(range(len(occurrences))))
+
+    def build(self, indices):
+        # Tree node of the occurrences indices (sorted by start):
+        # [center, indices containing center sorted by start, the same
+        # sorted by end descending, left node, right node]. The left node
+        # has the occurrences which end before center, the right node the
+        # ones which start after it.
+        if not indices:
+            return None
+        center = self.starts[indices[len(indices) // 2]]
+        left = []
+        node = []
+        right = []
+        for i in indices:
+            if self.ends[i] < center:
+                left.append(i)
+            elif self.starts[i] > center:
+                right.append(i)
+            else:
+                node.append(i)
+        return [center, node,
+                sorted(node, key=lambda i: self.ends[i], reverse=True),
+                self.build(left), self.build(right)]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def stab(self, t):
+        # indices of the occurrences with start < t < end
+        found = []
+        node = self.tree
+        while node is not None:
+            center, by_start, by_end, left, right = node
+            if t <= center:
+                for i in by_start:
+                    if self.starts[i] >= t:
+                        break
+                    if self.ends[i] > t:
+                        found.append(i)
+                node = left
+            else:
+                for i in by_end:
+                    if self.ends[i] <= t:
+                        break
+                    if self.starts[i] < t:
+                        found.append(i)
+                node = right
+        return found
+
+    def find(self, t_start, t_end):
+        # Return the (start, end, item) of the occurrences which overlap
+        # with the time window t_start..t_end
+        first = bisect_left(self.starts, t_start)
+        last = bisect_left(self.starts, t_end)
+        found = sorted(self.stab(t_start))
+        found += (i for i in range(first, last) if self.ends[i] > t_start)
+        return [(self.starts[i], self.ends[i], self.items[i]) for i in found]
+
+
+def dav_xml(response):
+    # Parse the XML body of a DAV response
+    raw = response.raw
+    if isinstance(raw, str):
+        raw = raw.encode()
+    return ElementTree.fromstring(raw)
+
+
+def dav_objects(response):
+    # Return the calendar objects of a REPORT response with calendar-data
+    # as dictionary href: (etag, ics data)
+    if response.status >= 400:
+        raise caldav.lib.error.ReportError(response.status)
+    objects = {}
+    for resp in dav_xml(response).iter('{DAV:}response'):
+        data = resp.findtext('.//{%s}calendar-data' % NS_C)
+        if data:
+            objects[resp.findtext('{DAV:}href')] = (
+                resp.findtext('.//{DAV:}getetag'), data)
+    return objects
+
+
+def calendar_multiget(calendar, hrefs):
+    # Download the calendar objects of all hrefs with one
+    # calendar-multiget REPORT (per MULTIGET_SIZE objects)
+    hrefs = list(hrefs)
+    objects = {}
+    for i in range(0, len(hrefs), MULTIGET_SIZE):
+        response = calendar.client.report(
+            str(calendar.url),
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<c:calendar-multiget xmlns:d="DAV:" xmlns:c="%s">'
+            '<d:prop><d:getetag/><c:calendar-data/></d:prop>%s'
+            '</c:calendar-multiget>' % (NS_C, ''.join(
+                '<d:href>%s</d:href>' % xml_escape(href)
+                for href in hrefs[i:i + MULTIGET_SIZE])), 1)
+        objects.update(dav_objects(response))
+    return objects
+
+
+def calendar_query(calendar, dt_start, dt_end):
+    # Search the calendar for events in the time interval dt_start..dt_end
+    # and download them with the same calendar-query REPORT
+    response = calendar.client.report(
+        str(calendar.url),
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<c:calendar-query xmlns:d="DAV:" xmlns:c="%s">'
+        '<d:prop><d:getetag/><c:calendar-data/></d:prop>'
+        '<c:filter><c:comp-filter name="VCALENDAR">'
+        '<c:comp-filter name="VEVENT">'
+        '<c:time-range start="%s" end="%s"/>'
+        '</c:comp-filter></c:comp-filter></c:filter>'
+        '</c:calendar-query>' % (
+            NS_C,
+            dt_start.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ'),
+            dt_end.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')), 1)
+    return dav_objects(response)
+
+
+def http_session():
+    # Shared HTTP session with a connection pool per server: the
+    # connections (and their TLS session) are kept alive and reused by
+    # all calendars, also after a reconnect, with gzip compression and
+    # the connect/read timeouts of the ini file. GET responses with an
+    # ETag are cached and requested again with If-None-Match.
+    global session
+    if session is not None:
+        return session
+    requests = importlib.import_module('requests')
+    timeout = (float(config['CALENDAR'].get('connect_timeout', '5')),
+               float(config['CALENDAR'].get('read_timeout', '30')))
+    workers = int(config['CALENDAR'].get('workers', '4'))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                            pool_maxsize=max(workers, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    request = session.request
+    # url: (etag, response), used by the fetch threads of find_all
+    etags = {}
+    lock = threading.Lock()
+
+    def conditional_request(method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = timeout
+        if method.upper() == 'GET':
+            with lock:
+                cached = etags.get(url)
+        else:
+            cached = None
+        if cached is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            kwargs['headers'].setdefault('If-None-Match', cached[0])
+        response = request(method, url, **kwargs)
+        if cached is not None and response.status_code == 304:
+            return cached[1]
+        if (method.upper() == 'GET' and response.status_code == 200
+                and 'ETag' in response.headers):
+            with lock:
+                etags.pop(url, None)
+                etags[url] = (response.headers['ETag'], response)
+                if len(etags) > ETAG_CACHE:
+                    del etags[next(iter(etags))]
+        return response
+    session.request = conditional_request
+    return session
+
+
+def count_requests(client):
+    # Count the HTTP round trips of the DAV client in dav_requests
+    request = client.request
+
+    def counted_request(*args, **kwargs):
+        global dav_requests
+        dav_requests += 1
+        return request(*args, **kwargs)
+    client.request = counted_request
+
+
+# Tables of the local event store
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    url TEXT PRIMARY KEY, ctag TEXT, sync_token TEXT,
+    expanded_from REAL, expanded_to REAL);
+CREATE TABLE IF NOT EXISTS objects (
+    url TEXT, href TEXT, etag TEXT, data TEXT,
+    PRIMARY KEY (url, href));
+CREATE TABLE IF NOT EXISTS occurrences (
+    url TEXT, href TEXT, component INTEGER,
+    occurrence_start REAL, occurrence_end REAL, switch TEXT);
+CREATE INDEX IF NOT EXISTS occurrences_time
+    ON occurrences (occurrence_start, occurrence_end, switch);
+"""
+
+
+class EventStore:
+    # Local SQLite store of the calendar objects of one collection and
+    # their occurrences. The occurrences are expanded once for the next
+    # 'expand' days and indexed by time, so the events of an interval are
+    # found by a local query, also while the calendar server is offline.
+
+    def __init__(self, filename, url, expand=2):
+        self.url = url
+        self.expand = timedelta(days=expand)
+        # used by one fetch thread at a time
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(STORE_SCHEMA)
+        self.db.execute('INSERT OR IGNORE INTO collections (url) VALUES (?)',
+                        (url,))
+        self.db.commit()
+        # href: (etag, list of vevents)
+        self.parsed = {}
+        # in memory index of the expanded occurrences
+        self.index = None
+        self.index_range = None
+
+    def get_sync_state(self):
+        return self.db.execute(
+            'SELECT ctag, sync_token FROM collections WHERE url = ?',
+            (self.url,)).fetchone()
+
+    def set_sync_state(self, ctag, sync_token):
+        self.db.execute(
+            'UPDATE collections SET ctag = ?, sync_token = ? WHERE url = ?',
+            (ctag, sync_token, self.url))
+
+    def etags(self):
+        return dict(self.db.execute(
+            'SELECT href, etag FROM objects WHERE url = ?', (self.url,)))
+
+    def put_object(self, href, etag, data):
+        self.db.execute(
+            'INSERT OR REPLACE INTO objects (url, href, etag, data) '
+            'VALUES (?, ?, ?, ?)', (self.url, href, etag, data))
+        self.invalidate()
+
+    def remove_object(self, href):
+        self.db.execute('DELETE FROM objects WHERE url = ? AND href = ?',
+                        (self.url, href))
+        self.parsed.pop(href, None)
+        self.invalidate()
+
+    def invalidate(self):
+        # occurrences need to be expanded again
+        self.index = None
+        self.db.execute('UPDATE collections SET expanded_to = NULL '
+                        'WHERE url = ?', (self.url,))
+
+    def commit(self):
+        self.db.commit()
+
+    def vevents(self, href, etag, data):
+        # Return the parsed VEVENT components of a calendar object
+        parsed = self.parsed.get(href)
+        if parsed is None or parsed[0] != etag:
+            try:
+                vevents = vobject.readOne(data).contents.get('vevent', [])
+            except Exception as e:
+                logging.error('Unable to parse calendar object %s: %s',
+                              href, e)
+                vevents = []
+            parsed = (etag, vevents)
+            self.parsed[href] = parsed
+        return parsed[1]
+
+    def expand_occurrences(self, dt_from, dt_to):
+        # Calculate the occurrences of all events between dt_from and dt_to
+        started = time.perf_counter()
+        self.db.execute('DELETE FROM occurrences WHERE url = ?', (self.url,))
+        rows = []
+        index = []
+        for href, etag, data in self.db.execute(
+                'SELECT href, etag, data FROM objects WHERE url = ?',
+                (self.url,)).fetchall():
+            vevents = self.vevents(href, etag, data)
+            try:
+                occurrences = expand_object(vevents, dt_from, dt_to)
+            except Exception as ex:
+                logging.error('Unable to expand event %s: %s', href, ex)
+                continue
+            for component, e_start_dt, e_end_dt in occurrences:
+                e = vevents[component]
+                switch = e.location.value if hasattr(e, 'location') else None
+                rows.append((self.url, href, component,
+                             e_start_dt.timestamp(),
+                             e_end_dt.timestamp(), switch))
+                index.append((rows[-1][3], rows[-1][4], (href, component)))
+        self.db.executemany(
+            'INSERT INTO occurrences (url, href, component, occurrence_start,'
+            ' occurrence_end, switch) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute(
+            'UPDATE collections SET expanded_from = ?, expanded_to = ? '
+            'WHERE url = ?', (dt_from.timestamp(), dt_to.timestamp(),
+                              self.url))
+        self.db.commit()
+        self.index = OccurrenceIndex(index)
+        self.index_range = (dt_from.timestamp(), dt_to.timestamp())
+        metrics.set('caltimer_parse_seconds', time.perf_counter() - started)
+        logging.info('Expanded %s event occurrences until %s', len(rows),
+                     dt_to)
+
+    def find(self, dt_start, dt_end):
+        # Return the (vevent, start, end) of all events which overlap with
+        # the time interval dt_start..dt_end
+        t_start = dt_start.timestamp()
+        t_end = dt_end.timestamp()
+        if self.index is None or not (self.index_range[0] <= t_start and
+                                      t_end <= self.index_range[1]):
+            self.index = None
+            expanded_from, expanded_to = self.db.execute(
+                'SELECT expanded_from, expanded_to FROM collections '
+                'WHERE url = ?', (self.url,)).fetchone()
+            if (expanded_to is None or expanded_from > t_start
+                    or expanded_to < t_end):
+                self.expand_occurrences(dt_start - timedelta(days=1),
+                                        dt_end + self.expand)
+        events = []
+        if self.index is not None:
+            # occurrences expanded by this process, query in memory
+            for occ_start, occ_end, (href, component) in self.index.find(
+                    t_start, t_end):
+                e = self.parsed[href][1][component]
+                events.append((e, datetime.fromtimestamp(occ_start),
+                               datetime.fromtimestamp(occ_end)))
+            return events
+        for href, etag, data, component, occ_start, occ_end in \
+                self.db.execute(
+                    'SELECT o.href, etag, data, component, occurrence_start,'
+                    ' occurrence_end FROM occurrences o JOIN objects b'
+                    ' ON o.url = b.url AND o.href = b.href'
+                    ' WHERE o.url = ? AND occurrence_start < ?'
+                    ' AND occurrence_end > ? ORDER BY occurrence_start',
+                    (self.url, t_end, t_start)):
+            e = self.vevents(href, etag, data)[component]
+            events.append((e, datetime.fromtimestamp(occ_start),
+                           datetime.fromtimestamp(occ_end)))
+        return events
+
+
+class CalendarSync:
+    # Keeps the event store up to date with the calendar collection:
+    #   - no query at all if the collection ctag didn't change
+    #   - only changed objects via sync-collection REPORT (RFC 6578)
+    #   - or, as fallback, by comparing the ETags of all objects
+
+    def __init__(self, calendar, store):
+        self.calendar = calendar
+        self.store = store
+
+    def get_ctag(self):
+        # Query the ctag and sync-token of the collection
+        response = self.calendar.client.propfind(
+            str(self.calendar.url),
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:propfind xmlns:d="DAV:" xmlns:cs="%s">'
+            '<d:prop><cs:getctag/><d:sync-token/></d:prop>'
+            '</d:propfind>' % NS_CS, 0)
+        tree = dav_xml(response)
+        ctag = tree.find('.//{%s}getctag' % NS_CS)
+        token = tree.find('.//{DAV:}sync-token')
+        return (ctag.text if ctag is not None else None,
+                token.text if token is not None else None)
+
+    def sync_collection(self, sync_token):
+        # Get the changed and removed objects since sync_token,
+        # all objects if sync_token is None
+        response = self.calendar.client.report(
+            str(self.calendar.url),
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:sync-collection xmlns:d="DAV:">'
+            '<d:sync-token>%s</d:sync-token>'
+            '<d:sync-level>1</d:sync-level>'
+            '<d:prop><d:getetag/></d:prop>'
+            '</d:sync-collection>' % (sync_token or ''), 1)
+        if response.status >= 400:
+            raise caldav.lib.error.ReportError(response.status)
+        tree = dav_xml(response)
+        changed = {}
+        removed = set()
+        for resp in tree.iter('{DAV:}response'):
+            href = resp.findtext('{DAV:}href')
+            if href.rstrip('/') == self.calendar.url.path.rstrip('/'):
+                continue
+            status = resp.findtext('{DAV:}status')
+            if status is not None and ' 404 ' in status:
+                removed.add(href)
+            else:
+                changed[href] = resp.findtext('.//{DAV:}getetag')
+        return changed, removed, tree.findtext('{DAV:}sync-token')
+
+    def list_etags(self):
+        # Get the ETags of all objects of the collection
+        response = self.calendar.client.propfind(
+            str(self.calendar.url),
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:propfind xmlns:d="DAV:">'
+            '<d:prop><d:getetag/></d:prop>'
+            '</d:propfind>', 1)
+        etags = {}
+        for resp in dav_xml(response).iter('{DAV:}response'):
+            href = resp.findtext('{DAV:}href')
+            if href.endswith('/'):
+                continue
+            etags[href] = resp.findtext('.//{DAV:}getetag')
+        return etags
+
+    def fetch(self, etags):
+        # Download the objects of the given hrefs into the store
+        if not etags:
+            return True
+        try:
+            objects = calendar_multiget(self.calendar, etags)
+        except Exception as e:
+            logging.info('calendar-multiget failed (%s), loading the '
+                         'objects one by one', e)
+        else:
+            for href, (etag, data) in objects.items():
+                self.store.put_object(href, etag or etags.get(href), data)
+            missing = set(etags) - set(objects)
+            if missing:
+                logging.error('calendar-multiget missed %s objects',
+                              len(missing))
+            return not missing
+        complete = True
+        for href, etag in etags.items():
+            event = caldav.Event(self.calendar.client,
+                                 url=self.calendar.url.join(href),
+                                 parent=self.calendar)
+            try:
+                event.load()
+            except Exception as e:
+                logging.error('Unable to load calendar object %s: %s',
+                              href, e)
+                complete = False
+                continue
+            self.store.put_object(href, etag, event.data)
+        return complete
+
+    def refresh(self):
+        # Update the event store from the calendar.
+        # Returns False if the calendar can't be synchronized.
+        try:
+            ctag, sync_token = self.get_ctag()
+        except Exception as e:
+            logging.error('Error to query the calendar ctag: %s', e)
+            return False
+        old_ctag, old_token = self.store.get_sync_state()
+        if ctag is not None and ctag == old_ctag:
+            logging.info('Calendar unchanged (ctag %s)', ctag)
+            return True
+        changed = None
+        if sync_token is not None and old_token is not None:
+            try:
+                changed, removed, new_token = self.sync_collection(old_token)
+            except Exception as e:
+                logging.info('Sync token not accepted (%s), full sync', e)
+        if changed is None:
+            stored = self.store.etags()
+            try:
+                if sync_token is not None:
+                    etags, _, new_token = self.sync_collection(None)
+                else:
+                    etags = self.list_etags()
+                    new_token = None
+            except Exception as e:
+                logging.error('Error to list the calendar objects: %s', e)
+                return False
+            changed = {href: etag for href, etag in etags.items()
+                       if stored.get(href) != etag}
+            removed = set(stored) - set(etags)
+        for href in removed:
+            self.store.remove_object(href)
+        logging.info('Calendar sync: %s changed, %s removed objects',
+                     len(changed), len(removed))
+        if self.fetch(changed):
+            self.store.set_sync_state(ctag, new_token or sync_token)
+        else:
+            # retry the missing objects with the next refresh
+            self.store.set_sync_state(None, None)
+        self.store.commit()
+        return True
+
+
+class IcsSync:
+    # Loads an iCalendar file into the event store, the same way as
+    # CalendarSync does for the calendar server (used by --simulate).
+    # Each event (UID) becomes one calendar object.
+
+    def __init__(self, filename, store):
+        self.filename = filename
+        self.store = store
+        self.mtime = None
+
+    def refresh(self):
+        try:
+            mtime = os.path.getmtime(self.filename)
+            if mtime == self.mtime:
+                return True
+            with open(self.filename) as f:
+                vcalendar = vobject.readOne(f)
+        except Exception as e:
+            logging.error('Unable to read calendar file %s: %s',
+                          self.filename, e)
+            return False
+        objects = {}
+        for vevent in vcalendar.contents.get('vevent', []):
+            uid = vevent.uid.value if hasattr(vevent, 'uid') else str(
+                len(objects))
+            if uid not in objects:
+                objects[uid] = vobject.iCalendar()
+            objects[uid].add(vevent)
+        for href in set(self.store.etags()) - set(objects):
+            self.store.remove_object(href)
+        for uid, obj in objects.items():
+            self.store.put_object(uid, str(mtime), obj.serialize())
+        self.store.commit()
+        self.mtime = mtime
+        logging.info('Loaded %s events from %s', len(objects), self.filename)
+        return True
+
+
+class EventRule:
+    # Options of an event description ([random], [sun]) compiled once:
+    # random ranges and sun offsets in seconds, sun modes as in SUN_MODES,
+    # None if the option isn't set (or is incorrect)
+    __slots__ = ('random_all', 'random_start', 'random_end', 'sun_start',
+                 'start_offset', 'sun_end', 'end_offset')
+
+    def __init__(self, event_options):
+        self.random_all = self.random_start = self.random_end = None
+        self.sun_start = self.sun_end = None
+        self.start_offset = self.end_offset = 0.0
+        if event_options.has_section('random'):
+            for option in ('all', 'start', 'end'):
+                if event_options.has_option('random', option):
+                    try:
+                        setattr(self, 'random_' + option, float(
+                            event_options['random'][option]) * 60)
+                    except ValueError:
+                        logging.error('Random %s is incorrect! Format is '
+                                      '"%s : 999"', option, option)
+        if event_options.has_section('sun'):
+            for option in ('start', 'end'):
+                if not event_options.has_option('sun', option):
+                    continue
+                if event_options['sun'][option] in SUN_MODES:
+                    setattr(self, 'sun_' + option,
+                            event_options['sun'][option])
+                else:
+                    # the offset is still applied to the event time
+                    setattr(self, 'sun_' + option, '')
+                    logging.error('Sunrise %s time option is incorrect, '
+                                  'valid options are "rise" or "set"',
+                                  option)
+                if event_options.has_option('sun', option + '_offset'):
+                    try:
+                        setattr(self, option + '_offset', float(
+                            event_options['sun'][option + '_offset']) * 60)
+                    except ValueError:
+                        logging.error('Sun %s offset format is incorrect! '
+                                      'Format is "%s_offset : 999"', option,
+                                      option)
+
+    def random(self):
+        # random offsets of the start and end time
+        r_time_1 = r_time_2 = 0
+        if self.random_all is not None:
+            r_time_1 = r_time_2 = uniform(0, self.random_all)
+        if self.random_start is not None:
+            r_time_1 = uniform(0, self.random_start)
+        if self.random_end is not None:
+            r_time_2 = uniform(0, self.random_end)
+        return r_time_1, r_time_2
+
+    def window(self):
+        # maximum random offsets of the start and end time
+        w_time_1 = w_time_2 = self.random_all or 0
+        if self.random_start is not None:
+            w_time_1 = self.random_start
+        if self.random_end is not None:
+            w_time_2 = self.random_end
+        return w_time_1, w_time_2
+
+    def start(self, e_start, rise, sunset):
+        # start time with the sun option, None to skip the start
+        mode = self.sun_start
+        if mode == 'rise':
+            e_start = rise
+        elif mode == 'set':
+            e_start = sunset
+        elif mode == 'before rise' and e_start > rise:
+            logging.debug('Defined start is after sun rise, but should be '
+                          'before -> skipping event')
+            return None
+        elif mode == 'after rise':
+            e_start = max(e_start, rise)
+        elif mode == 'before set' and e_start > sunset:
+            logging.debug('Defined start is after sun set, but should be '
+                          'before -> skipping event')
+            return None
+        elif mode == 'after set':
+            e_start = max(e_start, sunset)
+        return e_start + self.start_offset
+
+    def end(self, e_end, rise, sunset):
+        # end time with the sun option
+        mode = self.sun_end
+        if mode == 'rise':
+            e_end = rise
+        elif mode == 'set':
+            e_end = sunset
+        elif mode == 'before rise':
+            e_end = min(e_end, rise)
+        elif mode == 'after rise':
+            e_end = max(e_end, rise)
+        elif mode == 'before set':
+            e_end = min(e_end, sunset)
+        elif mode == 'after set':
+            e_end = max(e_end, sunset)
+        return e_end + self.end_offset
+
+
+def event_rule(e):
+    # Compiled options of the event description, cached by description
+    try:
+        description = e.description.value
+    except AttributeError:
+        description = '[DEFAULT]'
+    rule = event_rules.get(description)
+    if rule is not None:
+        return rule
+    event_options = configparser.ConfigParser()
+    try:
+        event_options.read_string(description)
+        logging.debug('Description: %s', description)
+    except configparser.Error:
+        logging.warning('Description incorrect for this event, '
+                        'treating as empty (no options)')
+        event_options = configparser.ConfigParser()
+    # logging event options at DEBUG level
+    if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
+        logging.debug('This event options have been found:')
+        for each_section in event_options.sections():
+            logging.debug('Section  %s :', each_section)
+            for (each_key, each_val) in (
+                    event_options.items(each_section)):
+                logging.debug('  %s : %s', each_key, each_val)
+    if len(event_rules) >= RULE_CACHE:
+        event_rules.clear()
+    rule = event_rules[description] = EventRule(event_options)
+    return rule
+
+
+def schedule_event(e, e_start_dt, e_end_dt, dt_start, dt_end, sun):
+    # Schedule the switch actions of one calendar event (vevent) with
+    # the start and end time e_start_dt, e_end_dt which fall into the
+    # time interval dt_start..dt_end.
+    # sun(day) returns the sunrise and sunset time of a date.
+    schedule_start = False
+    schedule_end = False
+    if not hasattr(e, 'location') or not hasattr(e, 'summary'):
+        logging.warning('Event %s without location or summary ignored',
+                        e.uid.value if hasattr(e, 'uid') else '-')
+        return
+    # check if the event has a known switch
+    # defined in the location field
+    if switch_defined(e.location.value):
+        e_start = e_start_dt.timestamp()
+        e_end = e_end_dt.timestamp()
+
+        # check if start/stop events are in current time interval
+        schedule_start = ((e_start >= dt_start.timestamp()) and
+                          (e_start < dt_end.timestamp()))
+        schedule_end = (e_end <= dt_end.timestamp())
+        # has the event a recurrence rule?
+        try:
+            rrule = e.rrule.value
+        except:
+            rrule = "-"
+
+        logging.debug(
+            'Found event "%s" start: %s end: %s RRule: %s',
+            e.summary.value,
+            e_start_dt.strftime('%Y-%m-%d %H:%M:%S'),
+            e_end_dt.strftime('%Y-%m-%d %H:%M:%S'), rrule)
+
+    # process event only if start or end is in current interval
+    if schedule_start or schedule_end:
+        logging.info('>>> Schedule event: %s starting at %s'
+                     ' (Frequency: %s)<<<',
+                     e.summary.value, e_start_dt.strftime("%H:%M"),
+                     rrule)
+        rule = event_rule(e)
+        r_time_1, r_time_2 = rule.random()
+        w_time_1, w_time_2 = rule.window()
+        if rule.sun_start is not None:
+            rise_time, set_time = sun(e_start_dt.date())
+            e_start = rule.start(e_start, rise_time.timestamp(),
+                                 set_time.timestamp())
+            if e_start is None:
+                schedule_start = False
+                e_start = e_start_dt.timestamp() + rule.start_offset
+        if rule.sun_end is not None:
+            rise_time, set_time = sun(e_end_dt.date())
+            e_end = rule.end(e_end, rise_time.timestamp(),
+                             set_time.timestamp())
+
+        # check if calculated start time is after the
+        # calculated end time => skip start event
+        # (keep end to ensure that "off" is sent)
+        if e_start+r_time_1 >= e_end+r_time_2:
+            schedule_start = False
+            logging.debug('Start time is after end time,'
+                          ' skipping start of event.')
+        # re-check end time
+        # >> not required (causes issues!)
+        # schedule_end = (e_end <= dt_end.timestamp())
+        if schedule_start:
+            logging.debug(
+                'Switch on %s at %s %+.1f min',
+                e.location.value,
+                datetime.fromtimestamp(e_start+r_time_1).strftime(
+                    '%Y-%m-%d %H:%M:%S'),
+                r_time_1 / 60)
+            try:
+                for sw in groups.get(e.location.value,
+                                     (switches.get(e.location.value),)):
+                    plan_command(sw, True, e_start+r_time_1,
+                                 (e_start, e_start+w_time_1))
+            except:
+                logging.critical('Error: %s at %s + %s',
+                                 e.summary.value,
+                                 datetime.fromtimestamp(
+                                     e_start).strftime(
+                                        '%Y-%m-%d %H:%M:%S'),
+                                 r_time_1, '!')
+        if schedule_end:
+            logging.debug(
+                'Switch off %s at %s %+.1f min',
+                e.location.value,
+                datetime.fromtimestamp(e_end+r_time_2).strftime(
+                    '%Y-%m-%d %H:%M:%S'),
+                r_time_2 / 60)
+            try:
+                for sw in groups.get(e.location.value,
+                                     (switches.get(e.location.value),)):
+                    plan_command(sw, False, e_end+r_time_2,
+                                 (e_end, e_end+w_time_2))
+            except:
+                logging.critical('Error for %s at %s + %s',
+                                 e.summary.value,
+                                 datetime.fromtimestamp(
+                                     e_end).strftime(
+                                        '%Y-%m-%d %H:%M:%S'),
+                                 r_time_2)
+        else:
+            logging.debug('End time %s is after current scheduler'
+                          ' interval, skipping end of event.',
+                          datetime.fromtimestamp(
+                              e_end).strftime('%Y-%m-%d %H:%M:%S'))
+    else:
+        logging.debug('Start and end time are not in current'
+                      ' interval, skipping...')
+
+
+def get_interval(dt, interval):
+    # calculate next start time after dt and the end of that interval
+    dt_start = dt + timedelta(minutes=interval - dt.minute % interval,
+                              seconds=-(dt.second % 60),
+                              microseconds=-(dt.microsecond % 1000000))
+    dt_end = dt_start + timedelta(minutes=interval)
+    return dt_start, dt_end
 
-    # Switch command options
-    # usage: switch_type[type]()
-    global switch_type
-    switch_type = {
-        'rf':    rf_switch,
-        'comag': rf_comag,
-        'zap':   rf_zap,
-        'kopp':  rf_kopp,
-        'gpio':  gpio_switch,
-        'pulse': gpio_pulse,
-        'dummy': dummy_switch,
-        }
 
+def open_gpio():
     # Raspberry Pi GPIO settings
+    global GPIO
+    GPIO = importlib.import_module('RPi.GPIO')
     GPIO.setmode(GPIO.BCM)
     GPIO.setwarnings(False)
 
+
+def open_serial():
+    global serial
+    serial = importlib.import_module('serial')
+
+
+def open_rpi_rf():
+    global RFDevice
+    RFDevice = importlib.import_module('rpi_rf').RFDevice
+
+
+def open_transmitters():
+    transmitters.clear()
+    transmitter_lanes.clear()
+    transmitter_failed.clear()
+
+
+def close_transmitters():
+    # Stop the transmit workers and nanoCULs, after sending the queued
+    # codes
+    for transmitter in transmitters.values():
+        transmitter.stop()
+    transmitters.clear()
+    transmitter_lanes.clear()
+
+
+def config_list(section, option):
+    # comma separated values of option, e.g. gpio : 17, 27
+    return [value.strip() for value in section.get(option, '').split(',')
+            if value.strip()]
+
+
+def use_transmitters(kind, values):
+    # Lanes of the transmitters of kind ('rf433', 'rpi-rf' or 'kopp') with
+    # the codesend commands, GPIO pins or serial ports values. Each one is
+    # opened by the first switch which uses it; the first RF transmitter
+    # has the lane 'rf', the next ones 'rf 2', 'rf 3', ..., the nanoCULs
+    # 'serial', 'serial 2', ...
+    use_hardware('transmitter')
+    lanes = []
+    for value in values:
+        if (kind, value) not in transmitter_lanes:
+            bus = 'serial' if kind == 'kopp' else 'rf'
+            count = sum(1 for lane in transmitters
+                        if lane.split()[0] == bus)
+            lane = '%s %s' % (bus, count + 1) if count else bus
+            transmitters[lane] = open_transmitter(kind, value, lane)
+            transmitter_lanes[kind, value] = lane
+        lanes.append(transmitter_lanes[kind, value])
+    return tuple(lanes)
+
+
+def open_transmitter(kind, value, lane):
+    if simulated:
+        return SimBackend(s, kind, value)
+    logging.debug('Open %s transmitter %s as lane %s', kind, value, lane)
+    if kind == 'kopp':
+        use_hardware('serial')
+        cul = CulTransport(
+            value, lane=lane,
+            queue_size=int(config['DEFAULT'].get('ser_queue', '32')),
+            batch=int(config['DEFAULT'].get('ser_batch', '4')),
+            timeout=float(config['DEFAULT'].get('ser_timeout', '1.0')),
+            retries=int(config['DEFAULT'].get('ser_retries', '2')))
+        if not cul.open():
+            logging.error("Can't open serial port %s, check ini file. "
+                          "Retrying with the first code.", value)
+        cul.start()
+        return cul
+    if kind == 'rpi-rf':
+        use_hardware('rpi-rf')
+        device = RFDevice(int(value))
+        device.enable_tx()
+        worker = TransmitWorker(lane, device=device)
+    else:
+        worker = TransmitWorker(lane, command=value)
+    worker.start()
+    return worker
+
+
+def open_agents():
+    # Connections to the switch agents
+    global agents
+    agents = {}
+    for name in config.sections():
+        address = config[name].get('agent')
+        if address is not None and address not in agents:
+            agents[address] = AgentClient(
+                address, config[name].get('agent_key'))
+
+
+def close_agents():
+    for agent in agents.values():
+        agent.close()
+
+
+# Hardware interfaces of the switch backends: name: (open, close).
+# Each interface is opened once, when the first switch which uses it is
+# compiled, and kept open for all following scheduler intervals.
+hardware = {
+    'gpio':    (open_gpio, None),
+    'serial':  (open_serial, None),
+    'rpi-rf':  (open_rpi_rf, None),
+    'transmitter': (open_transmitters, close_transmitters),
+    'agent':   (open_agents, close_agents),
+    }
+# names of the opened interfaces
+hardware_open = []
+
+
+def register_hardware(name, open, close=None):
+    # Add the hardware interface of a third-party backend
+    hardware[name] = (open, close)
+
+
+def use_hardware(name):
+    # Open the hardware interface name, if not yet done
+    if name not in hardware_open:
+        logging.debug('Open %s interface', name)
+        hardware[name][0]()
+        hardware_open.append(name)
+
+
+def close_hardware():
+    # Close the opened interfaces in reverse order
+    while hardware_open:
+        close = hardware[hardware_open.pop()][1]
+        if close is not None:
+            close()
+
+
+def init_simulation():
+    # Replace the hardware interfaces by the recording backend of the
+    # simulator s, before the switches are compiled
+    global GPIO, agents, simulated
+    GPIO = SimBackend(s)
+    agents = {config[name]['agent']: GPIO for name in config.sections()
+              if 'agent' in config[name]}
+    hardware_open[:] = hardware
+    simulated = True
+    open_transmitters()
+
+
+def connect_calendar(url, calname):
+    # Log in to the web calendar and look up the calendar by name.
+    # Returns None if the calendar can't be used.
+    global caldav
+    caldav = importlib.import_module('caldav')
+    client = caldav.DAVClient(url)
+    client.session.close()
+    client.session = http_session()
+    count_requests(client)
+    try:
+        principal = client.principal()
+        calendars = principal.calendars()
+    except:
+        e = sys.exc_info()[0]
+        logging.error('Error to access the web calendar: %s', e)
+        return None
+    if len(calendars) == 0:
+        logging.error('No calender found at URL: %s', url)
+        return None
+    # Check if specified calendar is available
+    calendar = next((c for c in calendars if c.name == calname), None)
+    if calendar is None:
+        logging.error('Calendar %s not found.', calname)
+        logging.error('Available calendars:')
+        for c in calendars:
+            logging.error('  %s ', c.name)
+        return None
+    logging.info("Using calendar %s", calendar)
+    return calendar
+
+
+class CalendarSource:
+    # One calendar of the ini file with its connection, sync and event
+    # store. The connection is opened with the first query and opened
+    # again after a failed query.
+    # Without event store, the events of the next 'horizon' hours are
+    # queried at once and used for the following intervals until the
+    # ctag of the calendar changes.
+
+    def __init__(self, url, calname, store, sync=None, horizon=0):
+        self.url = url
+        self.calname = calname
+        self.store = store
+        self.sync = sync
+        self.horizon = horizon
+        # (start, end, ctag, events) of the last query
+        self.window = None
+        self.calendar = None
+
+    def find(self, dt_start, dt_end):
+        # Return the (vevent, start, end) of the events of the interval,
+        # None if neither the calendar nor the store is available
+        if self.calendar is None and self.calname is not None:
+            self.calendar = connect_calendar(self.url, self.calname)
+            if self.calendar is not None and self.store is not None:
+                self.sync = CalendarSync(self.calendar, self.store)
+        if self.calendar is None and self.store is None:
+            return None
+        if self.store is None and self.horizon > 0:
+            events = self.find_horizon(dt_start, dt_end)
+        else:
+            events = find_events(self.calendar, self.sync, self.store,
+                                 dt_start, dt_end)
+        if events is None:
+            # force a new connection for the next interval
+            self.calendar = None
+        return events
+
+    def find_horizon(self, dt_start, dt_end):
+        # Take the events from the last query if it covers the interval
+        # and the calendar didn't change, otherwise query the calendar
+        # for the interval and the following horizon
+        try:
+            ctag = CalendarSync(self.calendar, None).get_ctag()[0]
+        except Exception as e:
+            logging.error('Error to query the calendar ctag: %s', e)
+            ctag = None
+            if self.window is None:
+                return None
+            logging.warning('Calendar not available, using the events of '
+                            'the last query')
+        else:
+            if (self.window is None or ctag is None
+                    or ctag != self.window[2]
+                    or dt_start < self.window[0]
+                    or dt_end > self.window[1]):
+                end = dt_end + timedelta(hours=self.horizon)
+                events = find_events(self.calendar, None, None, dt_start,
+                                     end)
+                if events is None:
+                    return None
+                logging.info('Queried %s events until %s', len(events), end)
+                self.window = (dt_start, end, ctag, events)
+            else:
+                logging.info('Calendar unchanged (ctag %s), using the '
+                             'events queried until %s', ctag, self.window[1])
+        t_start = dt_start.timestamp()
+        t_end = dt_end.timestamp()
+        return [(e, e_start_dt, e_end_dt)
+                for e, e_start_dt, e_end_dt in self.window[3]
+                if e_start_dt.timestamp() < t_end
+                and e_end_dt.timestamp() > t_start]
+
+
+def calendar_sources(daemon=False):
+    # Calendars of the ini file: the calendars 'calname' (comma separated)
+    # of the 'caldav' server and of each line 'url name, name' of 'servers'.
+    # The query horizon is only used by the daemon, a cron run queries
+    # its interval.
+    sources = []
+    if daemon:
+        horizon = float(config['CALENDAR'].get('horizon', '12'))
+    else:
+        horizon = 0
+    servers = [config['CALENDAR']['caldav'] + ' ' +
+               config['CALENDAR']['calname']]
+    servers += config['CALENDAR'].get('servers', '').splitlines()
+    for server in servers:
+        url, _, names = server.strip().partition(' ')
+        for calname in names.split(','):
+            calname = calname.strip()
+            if url and calname:
+                # the first calendar keeps the store of a single calendar
+                key = url if len(sources) == 0 else url + '#' + calname
+                sources.append(CalendarSource(url, calname, open_store(key),
+                                              horizon=horizon))
+    return sources
+
+
+def find_all(sources, dt_start, dt_end):
+    # Query all calendars concurrently and merge their events. An event
+    # found in several calendars (same UID, start and switch) is only
+    # used once. Returns None if no calendar is available.
+    if len(sources) == 1:
+        results = [sources[0].find(dt_start, dt_end)]
+    else:
+        workers = int(config['CALENDAR'].get('workers', '4'))
+        with ThreadPoolExecutor(min(workers, len(sources))) as pool:
+            results = list(pool.map(
+                lambda source: source.find(dt_start, dt_end), sources))
+    if all(events is None for events in results):
+        return None
+    merged = []
+    seen = set()
+    for events in results:
+        for e, e_start_dt, e_end_dt in events or ():
+            if hasattr(e, 'uid'):
+                key = (e.uid.value, e_start_dt,
+                       e.location.value if hasattr(e, 'location') else None)
+                if key in seen:
+                    continue
+                seen.add(key)
+            merged.append((e, e_start_dt, e_end_dt))
+    if len(sources) > 1:
+        logging.info('%s events of %s calendars, %s duplicates removed',
+                     len(merged), len(sources),
+                     sum(len(events or ()) for events in results)
+                     - len(merged))
+    return merged
+
+
+def find_events(calendar, sync, store, dt_start, dt_end):
+    # Return the (vevent, start, end) of all events which overlap with
+    # the time interval dt_start..dt_end, None if the query failed.
+    if store is not None:
+        if sync is None or not sync.refresh():
+            logging.warning('Calendar not available, using the events of '
+                            'the local store')
+        return store.find(dt_start, dt_end)
+
+    # Server doesn't support sync, search for the interval
+    try:
+        results = calendar_query(calendar, dt_start, dt_end)
+    except Exception as e:
+        logging.error('Error to search the web calendar: %s', e)
+        return None
+    started = time.perf_counter()
+    events = []
+    for href, (etag, data) in results.items():
+        try:
+            vevents = vobject.readOne(data).contents.get('vevent', [])
+        except Exception as e:
+            logging.error('Unable to parse calendar object %s: %s', href, e)
+            continue
+        for component, e_start_dt, e_end_dt in expand_object(
+                vevents, dt_start, dt_end):
+            events.append((vevents[component], e_start_dt, e_end_dt))
+    metrics.set('caltimer_parse_seconds', time.perf_counter() - started)
+    return events
+
+
+def schedule_interval(sources, dt_start, dt_end, args):
+    # Get the events of all calendar sources for the interval
+    # dt_start..dt_end and add the switch events to the scheduler s.
+    # Returns the number of events found, None if the query failed.
+
+    global dav_requests
+    logging.info("Get events between: %s and %s", dt_start, dt_end)
+    started = time.perf_counter()
+    events = find_all(sources, dt_start, dt_end)
+    metrics.set('caltimer_fetch_seconds', time.perf_counter() - started)
+    metrics.set('caltimer_dav_requests', dav_requests)
+    logging.info('Calendar round trips for this interval: %s', dav_requests)
+    dav_requests = 0
+    metrics.set('caltimer_last_interval_timestamp_seconds',
+                dt_start.timestamp())
+    if events is None:
+        return None
+    metrics.set('caltimer_window_events', len(events))
+    logging.debug('%s events found for defined period.', len(events))
+
+    if len(events) > 0:
+        # check if longitude/latitude is set in ini file
+        # otherwise use location to query them from google maps
+        if not (config.has_option('CALENDAR', 'latitude') and
+                config.has_option('CALENDAR', 'longitude')):
+            if config.has_option('CALENDAR', 'location'):
+                logging.info('Get coordinates from location address')
+                get_location(args.init, config['CALENDAR']['location'])
+                if args.update:
+                    update_ini(args.init)
+            else:
+                logging.error('Coordinates and location not defined, exit')
+                return None
+
+        # get sunrise and sunset
+        sun = sun_days(args)
+        logging.info('Sunrise %s, sunset %s', *sun(dt_start.date()))
+
+        # schedule events
+        started = time.perf_counter()
+        for e, e_start_dt, e_end_dt in events:
+            schedule_event(e, e_start_dt, e_end_dt, dt_start, dt_end, sun)
+        commit_plan()
+        airtime.commit()
+        # push the commands of the remote switches to their agents
+        for agent in set(agents.values()):
+            agent.flush()
+        metrics.set('caltimer_schedule_seconds',
+                    time.perf_counter() - started)
+        logging.debug('Scheduler queue:\n%s', s.queue)
+    return len(events)
+
+
+def reconcile(sources, args):
+    # Bring the switches into the state of the calendar at the current
+    # time, e.g. after a restart, a crash or a skipped cron run: the
+    # events of the last day are planned as usual and the last command
+    # of each switch up to now is compared with the journal. Switches
+    # which are on without an event are switched off, switches without
+    # a journaled state are left alone. The random offsets are rolled
+    # again here, so a switch with an event edge inside its random window
+    # is left alone too: it's switched at the offset of the earlier run.
+    # Returns the number of switch commands scheduled.
+    now = datetime.now()
+    events = find_all(sources, now - timedelta(days=1),
+                      now + timedelta(seconds=1))
+    if events is None:
+        return 0
+
+    sun = sun_days(args)
+    logging.info('Reconcile the switch states with %s current events',
+                 len(events))
+    for e, e_start_dt, e_end_dt in events:
+        schedule_event(e, e_start_dt, e_end_dt, e_start_dt,
+                       max(e_end_dt, now) + timedelta(days=1), sun)
+    intended = {}
+    pending = set()
+    for stime, _, sw, onoff, window in sorted(plan, key=lambda c: c[:2]):
+        if sw.type == 'pulse':
+            continue
+        if window[0] <= now.timestamp() < window[1]:
+            pending.add(sw.name)
+        elif stime <= now.timestamp():
+            intended[sw.name] = (sw, onoff)
+    plan.clear()
+    for name, (onoff, _) in journal.state.items():
+        if onoff and name not in intended and name in switches:
+            intended[name] = (switches[name], False)
+    for name in pending:
+        logging.debug('Switch %s is inside a random window, not reconciled',
+                      name)
+        intended.pop(name, None)
+    stime = time.time()
+    for name, (sw, onoff) in intended.items():
+        if journal.get(name) is not None and journal.get(name) != onoff:
+            logging.warning('Switch %s should be %s, but was last switched '
+                            '%s', name, switch_state[onoff],
+                            switch_state[journal.get(name)])
+            journal.planned.pop(name, None)
+            plan_command(sw, onoff, stime)
+    count = len(plan)
+    commit_plan()
+    airtime.commit()
+    for agent in set(agents.values()):
+        agent.flush()
+    return count
+
+
+def write_metrics():
+    # Write the metrics textfile, if defined in the ini file
+    if config.has_option('LOGGING', 'metrics_file'):
+        metrics.write(config['LOGGING']['metrics_file'])
+
+
+def open_store(url):
+    # Open the local event store of the collection url,
+    # None if the calendar sync is disabled
+    if not config['CALENDAR'].getboolean('sync', True):
+        return None
+    filename = config['CALENDAR'].get('store', '/var/lib/caltimer/events.db')
+    try:
+        return EventStore(filename, url,
+                          int(config['CALENDAR'].get('expand', '2')))
+    except (sqlite3.Error, ValueError) as e:
+        logging.error('Unable to open event store %s: %s', filename, e)
+        return None
+
+
+def run_daemon(sources, interval, args):
+    # Long running mode: keep the calendar connections and the hardware
+    # open and schedule one interval after the other.
+    # The calendars are queried 'lead' seconds before each interval starts.
+    # An error of one interval (e.g. of the calendar server or the event
+    # store) is logged and the daemon continues with the next one.
+    try:
+        lead = int(config['CALENDAR'].get('lead', '60'))
+    except ValueError:
+        logging.error('Defined lead time is not an integer number!')
+        return
+    logging.info('Start caltimer daemon, interval %s min, lead time %s s',
+                 interval, lead)
+    dt_start, dt_end = get_interval(datetime.today(), interval)
+    while True:
+        try:
+            schedule_interval(sources, dt_start, dt_end, args)
+        except Exception as e:
+            logging.error('Scheduling the interval %s failed: %s',
+                          dt_start.strftime('%Y-%m-%d %H:%M'), e)
+            metrics.inc('caltimer_errors_total', type='interval')
+            # drop the partly planned interval
+            plan.clear()
+            airtime.pending = []
+        # the dispatcher executes the scheduled events
+        # until the next calendar query
+        dt_start, dt_end = dt_end, dt_end + timedelta(minutes=interval)
+        time.sleep(max(dt_start.timestamp() - lead - time.time(), 0))
+        s.log_stats()
+        write_metrics()
+
+
+def run_compile(sources, interval, hours, filename, args):
+    # Plan the intervals of the next hours into the timeline file of
+    # caltimer_exec.py. The previous file is kept if the events of an
+    # interval can't be found.
+    dt_start, dt_end = get_interval(datetime.today(), interval)
+    dt_to = dt_start + timedelta(hours=hours)
+    logging.info('Compile %s to %s', dt_start, dt_to)
+    s.now = dt_start.timestamp()
+    if any('agent' in config[name] for name in config.sections()):
+        logging.warning('Switches of agents are not compiled into the '
+                        'timeline')
+    while dt_start < dt_to:
+        if schedule_interval(sources, dt_start, dt_end, args) is None:
+            logging.error('No events for %s, timeline %s not updated',
+                          dt_start, filename)
+            return
+        s.run(dt_end.timestamp())
+        dt_start, dt_end = dt_end, dt_end + timedelta(minutes=interval)
+    s.run()
+    s.log_stats()
+    s.write(filename, {'interval': interval,
+                       'gpio': config['DEFAULT'].get('gpio'),
+                       'ser_port': config['DEFAULT'].get('ser_port'),
+                       'ser_timeout': config['DEFAULT'].get('ser_timeout',
+                                                            '1.0')})
+
+
+def run_simulation(sources, interval, dt_from, dt_to, args):
+    # Schedule and execute all intervals between dt_from and dt_to
+    # against the virtual clock of the simulator s
+    logging.info('Simulate %s to %s', dt_from, dt_to)
+    dt_start, dt_end = get_interval(dt_from - timedelta(minutes=interval),
+                                    interval)
+    s.now = dt_start.timestamp()
+    while dt_start < dt_to:
+        schedule_interval(sources, dt_start, dt_end, args)
+        s.run(dt_end.timestamp())
+        dt_start, dt_end = dt_end, dt_end + timedelta(minutes=interval)
+    # events scheduled after the last interval (e.g. second_switch)
+    s.run()
+    s.log_stats()
+
+
+def run_agent(address, name):
+    # Agent mode: execute the switch commands pushed by the planner with
+    # the local hardware
+    server = AgentServer(address, config['DEFAULT'].get('agent_key'))
+    logging.info('Start caltimer agent %s on %s with %s switches', name,
+                 address, len(switches))
+    if not any(config[section].get('agent') == name
+               for section in config.sections()):
+        logging.warning('No switches with "agent : %s" defined, set the '
+                        'address of the planner with --agent-name', name)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def terminate(signum, frame):
+    logging.info('Received signal %s, stopping caltimer.', signum)
+    sys.exit(0)
+
+
+#############################################################
+# MAIN                                                      #
+#############################################################
+def main():
+
     # Comamnd line arguments
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter)
@@ -449,6 +3319,29 @@ def main():
     parser.add_argument('-u', '--update',
                         help='Update ini file (e.g. log level)',
                         action='store_true')
+    parser.add_argument('-d', '--daemon',
+                        help='keep running and schedule one interval after\n'
+                        'the other (instead of a cron job per interval)',
+                        action='store_true')
+    parser.add_argument('--agent', metavar='ADDRESS',
+                        help='run as switch agent of a planner on\n'
+                        '"host:port" or a Unix socket path')
+    parser.add_argument('--agent-name', metavar='NAME',
+                        help='"agent" option of the switches of this agent\n'
+                        '(default: the address of --agent)')
+    parser.add_argument('--simulate', nargs=2, metavar=('FROM', 'TO'),
+                        help='replay the calendar file of --ics between\n'
+                        'FROM and TO ("2019-01-01" or "2019-01-01 12:00")\n'
+                        'without hardware and write the switching timeline')
+    parser.add_argument('--ics',
+                        help='iCalendar file for --simulate')
+    parser.add_argument('--timeline', default='-',
+                        help='timeline file of --simulate (default stdout)')
+    parser.add_argument('--compile', metavar='FILE',
+                        help='plan the next --hours into the binary\n'
+                        'timeline FILE for caltimer_exec.py')
+    parser.add_argument('--hours', type=float, default=24,
+                        help='hours planned by --compile (default 24)')
     args = parser.parse_args()
 
     # Read ini file for RC switch definition
@@ -465,36 +3358,53 @@ def main():
     # set logfile destination and log level
     configure_logging(args.log, args.update, args.init)
 
-    if config.has_option('DEFAULT', 'pulselength'):
-        pulse_comag = int(config['DEFAULT']['pulselength'])
-        logging.debug('Setting pulse_comag = %s', pulse_comag)
-
-    if config.has_option('DEFAULT', 'zap_pulse'):
-        pulse_zap = int(config['DEFAULT']['zap_pulse'])
-        logging.debug('Setting pulse_zap = %s', pulse_zap)
-
-    if config.has_option('DEFAULT', 'kopp_time'):
-        kopp_time = config['DEFAULT']['kopp_time'].zfill(5)
-        logging.debug('Setting kopp_time = %s', kopp_time)
-
-    if config.has_option('DEFAULT', 'ser_port'):
+    global s, airtime, journal, failover_time
+    failover_time = float(config['DEFAULT'].get('failover_time', '600'))
+    if args.simulate is not None:
         try:
-            logging.debug('Create serial interface %s',
-                          config['DEFAULT']['ser_port'])
-            global ser
-            ser = serial.Serial(config['DEFAULT']['ser_port'],
-                                38400, timeout=0)
-        except:
-            logging.error("Can't open serial port %s, check ini file.",
-                          config['DEFAULT']['ser_port'])
-
-    # Enable RF transmitter
-    global rfdevice
-    rfdevice = RFDevice(int(config['DEFAULT']['gpio']))
-    rfdevice.enable_tx()
+            dt_from, dt_to = (datetime.fromisoformat(d)
+                              for d in args.simulate)
+        except ValueError:
+            logging.error('Simulation times must be "YYYY-MM-DD" '
+                          'or "YYYY-MM-DD HH:MM"')
+            return
+        if args.ics is None:
+            logging.error('--simulate needs the calendar file --ics')
+            return
+        if args.timeline == '-':
+            timeline = sys.stdout
+        else:
+            timeline = open(args.timeline, 'w')
+        s = Simulator(timeline)
+        init_simulation()
+    elif args.compile is not None:
+        s = TimelineCompiler()
+        init_simulation()
+    if args.agent is not None:
+        agent = args.agent_name or args.agent
+    else:
+        agent = None
+    if not compile_switches(agent):
+        close_hardware()
+        return
 
-    # Time zone offset
-    tzoffset = datetime.today().hour-datetime.utcnow().hour
+    if args.agent is not None:
+        s = Dispatcher()
+        airtime = AirtimePlanner(float(config['DEFAULT'].get('rf_gap',
+                                                             '0.1')))
+        signal.signal(signal.SIGTERM, terminate)
+        if config.has_option('LOGGING', 'metrics_port'):
+            metrics.serve(config['LOGGING'].get('metrics_address',
+                                                '127.0.0.1'),
+                          int(config['LOGGING']['metrics_port']))
+        try:
+            run_agent(args.agent, agent)
+        except KeyboardInterrupt:
+            logging.info('Stopping caltimer agent.')
+        finally:
+            s.stop()
+            close_hardware()
+        return
 
     # get coordinates from address
     if args.address is not None:
@@ -503,14 +3413,6 @@ def main():
         if args.update:
             update_ini(args.init)
 
-    # Set Caldav url
-    try:
-        url = config['CALENDAR']['caldav']
-    except:
-        logging.error('Missing or incorrect ini file,'
-                      ' please check /etc/caltimer/caltimer.ini')
-        return
-
     # Scheduler interval in minutes
     try:
         if args.time_interval is not None:
@@ -523,358 +3425,88 @@ def main():
     except:
         logging.error(
             'Defined scheduler time interval is not an integer number!')
+        close_hardware()
         return
 
-    # event options
-    event_options = configparser.ConfigParser()
+    airtime = AirtimePlanner(float(config['DEFAULT'].get('rf_gap', '0.1')))
+
+    if args.simulate is not None:
+        store = EventStore(':memory:', args.ics,
+                           int(config['CALENDAR'].get('expand', '2')))
+        run_simulation([CalendarSource(args.ics, None, store,
+                                       IcsSync(args.ics, store))],
+                       interval, dt_from, dt_to, args)
+        if timeline is not sys.stdout:
+            timeline.close()
+        close_hardware()
+        return
 
-    # try to access the web calendar
-    client = caldav.DAVClient(url)
+    # Set Caldav url and calendars
     try:
-        principal = client.principal()
+        sources = calendar_sources(args.daemon)
     except:
-        e = sys.exc_info()[0]
-        logging.error('Error to access the web calendar: %s', e)
-        return
-    calendars = principal.calendars()
-    if len(calendars) == 0:
-        logging.error('No calender found at URL: %s', url)
+        logging.error('Missing or incorrect ini file,'
+                      ' please check /etc/caltimer/caltimer.ini')
+        close_hardware()
         return
-    else:
-        # Check if specified calendar is available
-        calendar = next((c for c in calendars if
-                         c.name == config['CALENDAR']['calname']), None)
-        if calendar is None:
-            logging.error(
-                'Calendar %s not found.', config['CALENDAR']['calname'])
-            logging.error('Available calendars:')
-            for calendar in calendars:
-                logging.error('  %s ', calendar.name)
-            return
-        logging.info("Using calendar %s", calendar)
-
-    # Specified calendar is available
 
-    # get start and end times for next time interval
-    dt = datetime.today()
-    # calculate next start time after current time
-    dt_start = dt + timedelta(minutes=interval - dt.minute % interval,
-                              seconds=-(dt.second % 60),
-                              microseconds=-(dt.microsecond % 1000000))
-    dt_end = dt_start + timedelta(minutes=interval)
+    if args.compile is not None:
+        run_compile(sources, interval, args.hours, args.compile, args)
+        close_hardware()
+        return
 
-    logging.info("Get events between: %s and %s", dt_start, dt_end)
-    results = calendar.date_search(
-        dt_start - timedelta(hours=tzoffset),
-        dt_end - timedelta(hours=tzoffset))
-    logging.debug('%s events found for defined period.', len(results))
+    logging.debug('Define scheduler')
+    s = Dispatcher()
 
-    # is below required? Seems to be set again later
-    r_time_1 = 0
-    r_time_2 = 0
+    if config.has_option('LOGGING', 'metrics_file'):
+        metrics.load(config['LOGGING']['metrics_file'])
 
-    if len(results) > 0:
-        # check if longitude/latitude is set in ini file
-        # otherwise use location to query them from google maps
-        if not (config.has_option('CALENDAR', 'latitude') and
-                config.has_option('CALENDAR', 'longitude')):
-            if config.has_option('CALENDAR', 'location'):
-                logging.info('Get coordinates from location address')
-                get_location(args.init, config['CALENDAR']['location'])
-                if args.update:
-                    update_ini(args.init)
-            else:
-                logging.error('Coordinates and location not defined, exit')
-                return
-
-        # get sunrise and sunset
-        rise_time, set_time = get_sun(tzoffset, args.sun_rise, args.sun_set)
+    filename = config['CALENDAR'].get('journal',
+                                      '/var/lib/caltimer/switches.journal')
+    if filename:
+        journal = StateJournal(filename)
+    # without the journal file the state of the last run is unknown
+    if config['CALENDAR'].getboolean('reconcile', True) and \
+            journal.file is not None:
+        reconciled = reconcile(sources, args)
+    else:
+        reconciled = 0
+
+    if args.daemon:
+        signal.signal(signal.SIGTERM, terminate)
+        if config.has_option('LOGGING', 'metrics_port'):
+            metrics.serve(config['LOGGING'].get('metrics_address',
+                                                '127.0.0.1'),
+                          int(config['LOGGING']['metrics_port']))
+        try:
+            run_daemon(sources, interval, args)
+        except KeyboardInterrupt:
+            logging.info('Stopping caltimer daemon.')
+        finally:
+            s.stop()
+            close_hardware()
+            journal.close()
+            write_metrics()
+        return
 
-        # schedule events
-        logging.debug('Define scheduler')
-        global s
-        s = sched.scheduler(time.time, time.sleep)
-        for event in results:
-            event.load()
-            e = event.instance.vevent
-            schedule_start = False
-            schedule_end = False
-            # check if the event has a known switch
-            # defined in the location field
-            if switch_defined(e.location.value):
-                # Calculate event start/end time for current date
-                # (required for recurring events)
-                # TODO: possible issue if interval would span across midnight
-                e_start_dt = datetime.combine(date.today(),
-                                              e.dtstart.value.time())
-                e_end_dt = datetime.combine(date.today(),
-                                            e.dtend.value.time())
-                e_start = e_start_dt.timestamp()
-                e_end = e_end_dt.timestamp()
-
-                # check if start/stop events are in current time interval
-                schedule_start = ((e_start >= dt_start.timestamp()) and
-                                  (e_start < dt_end.timestamp()))
-                schedule_end = (e_end <= dt_end.timestamp())
-                # has the event a recurrence rule?
-                try:
-                    rrule = e.rrule.value
-                except:
-                    rrule = "-"
-
-                logging.debug(
-                    'Found event "%s" start: %s end: %s RRule: %s',
-                    e.summary.value,
-                    e_start_dt.strftime('%Y-%m-%d %H:%M:%S'),
-                    e_end_dt.strftime('%Y-%m-%d %H:%M:%S'), rrule)
-
-            # process event only if start or end is in current interval
-            if schedule_start or schedule_end:
-                logging.info('>>> Schedule event: %s starting at %s'
-                             ' (Frequency: %s)<<<',
-                             e.summary.value, e_start_dt.strftime("%H:%M"),
-                             rrule)
-                # clear event options from previous event
-                event_options = configparser.ConfigParser()
-                try:
-                    description = e.description.value
-                except:
-                    logging.debug('No description for this event')
-                    # define empty description to clear previous
-                    description = '[DEFAULT]'
-                try:
-                    event_options.read_string(description)
-                    logging.debug('Description: %s', description)
-                except:
-                    logging.warning('Description incorrect for this event, '
-                                    'treating as empty (no options)')
-
-                # logging event options at DEBUG level
-                if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-                    logging.debug('This event options have been found:')
-                    for each_section in event_options.sections():
-                        logging.debug('Section  %s :', each_section)
-                        for (each_key, each_val) in (
-                                event_options.items(each_section)):
-                            logging.debug('  %s : %s', each_key, each_val)
-
-                r_time_1 = 0
-                r_time_2 = 0
-                # if there are random numbers define
-                if event_options.has_section('random'):
-                    if event_options.has_option('random', 'all'):
-                        try:
-                            # calculate random value from
-                            # defined range
-                            r_time_1 = uniform(
-                                0, float(event_options['random']['all']) * 60)
-                            r_time_2 = r_time_1
-                        except:
-                            logging.error('Random all is incorrect!'
-                                          ' Format is "all : 999"')
-                    if event_options.has_option('random', 'start'):
-                        try:
-                            # calculate random value from
-                            # defined range
-                            r_time_1 = uniform(0, float(
-                                event_options['random']['start']) * 60)
-                        except:
-                            logging.error('Random start is incorrect!'
-                                          ' Format is "start : 999"')
-                    if event_options.has_option('random', 'end'):
-                        try:
-                            # calculate random value from defined range
-                            r_time_2 = uniform(
-                                0, float(event_options['random']['end']) * 60)
-                        except:
-                            logging.error('Random end is incorrect!'
-                                          ' Format is "end : 999"')
-                if event_options.has_section('sun'):
-                    # first check all possible start options
-                    if event_options.has_option('sun', 'start'):
-                        if event_options['sun']['start'] == "rise":
-                            e_start = rise_time.timestamp()
-                        elif event_options['sun']['start'] == "set":
-                            e_start = set_time.timestamp()
-                        elif event_options['sun']['start'] == "before rise":
-                            # start time is after sunrise
-                            # = skip event start
-                            if e_start > rise_time.timestamp():
-                                schedule_start = False
-                                logging.debug(
-                                    'Defined start is after sun rise, but'
-                                    ' should be before -> skipping event')
-                        elif event_options['sun']['start'] == "after rise":
-                            # start time is before sunrise,
-                            # set start = sun rise
-                            if e_start < rise_time.timestamp():
-                                e_start = rise_time.timestamp()
-                                logging.debug(
-                                    'Defined start time is before sun rise,'
-                                    ' but should be after -> setting start'
-                                    ' time = sun rise')
-                        elif event_options['sun']['start'] == "before set":
-                            # start time is after sun set,
-                            # skip event start
-                            if e_start > set_time.timestamp():
-                                schedule_start = False
-                                logging.debug(
-                                    'Defined start is after sun set, but'
-                                    ' should be before -> skipping event')
-                        elif event_options['sun']['start'] == "after set":
-                            # start time is before sun set,
-                            # set start = sun set
-                            if e_start < set_time.timestamp():
-                                e_start = set_time.timestamp()
-                                logging.debug(
-                                    'Defined start time is before sun'
-                                    ' set, but should be after ->'
-                                    ' setting start time = sun set')
-                        else:
-                            logging.error(
-                                'Sunrise start time option is incorrect,'
-                                ' valid options are "rise" or "set"')
-                        if event_options.has_option('sun', 'start_offset'):
-                            try:  # add start offset
-                                # sunrise + offset
-                                e_start = e_start+(float(event_options[
-                                    'sun']['start_offset']) * 60)
-                            except:
-                                logging.error(
-                                    'Sunrise start offset format is'
-                                    ' incorrect! Format is'
-                                    ' "start_offset : 999"')
-                    # now check all the end options
-                    if event_options.has_option('sun', 'end'):
-                        if event_options['sun']['end'] == "rise":
-                            e_end = rise_time.timestamp()
-                        elif event_options['sun']['end'] == "set":
-                            e_end = set_time.timestamp()
-                        elif event_options['sun']['end'] == "before rise":
-                            # end time is after sunrise,
-                            # set end = sun rise
-                            if e_end > rise_time.timestamp():
-                                e_end = rise_time.timestamp()
-                                logging.debug(
-                                    'Defined end time is after sun'
-                                    ' rise, but should be before ->'
-                                    ' setting end time = sun rise')
-                        elif event_options['sun']['end'] == "after rise":
-                            # end time is before sunrise,
-                            # set end = sun rise
-                            if e_end < rise_time.timestamp():
-                                e_end = rise_time.timestamp()
-                                logging.debug(
-                                    'Defined end time is before sun'
-                                    ' rise, but should be after ->'
-                                    ' setting end time = sun rise')
-                        elif event_options['sun']['end'] == "before set":
-                            # end time is after sun set,
-                            # set end  = sun set
-                            if e_end > set_time.timestamp():
-                                e_end = set_time.timestamp()
-                                logging.debug(
-                                    'Defined end time is after sun '
-                                    'set, but should be before ->'
-                                    ' setting end time = sun set')
-                        elif event_options['sun']['end'] == "after set":
-                            # end time is before sun set,
-                            # set end = sun set
-                            if e_end < set_time.timestamp():
-                                e_end = set_time.timestamp()
-                                logging.debug(
-                                    'Defined end time is before sun'
-                                    ' set, but should be after ->'
-                                    ' setting end time = sun set')
-                        else:
-                            logging.error(
-                                'Sunrise end time option is '
-                                'incorrect, valid options are'
-                                ' "rise" or "set"')
-                        if event_options.has_option('sun', 'end_offset'):
-                            try:  # add end offset
-                                # sunset + offset
-                                e_end = e_end + (float(event_options[
-                                    'sun']['end_offset']) * 60)
-                            except:
-                                logging.error(
-                                    'Sunset end offset format is'
-                                    ' incorrect! Format is'
-                                    ' "end_offset : 999"')
-
-                # check if calculated start time is after the
-                # calculated end time => skip start event
-                # (keep end to ensure that "off" is sent)
-                if e_start+r_time_1 >= e_end+r_time_2:
-                    schedule_start = False
-                    logging.debug('Start time is after end time,'
-                                  ' skipping start of event.')
-                # re-check end time
-                # >> not required (causes issues!)
-                # schedule_end = (e_end <= dt_end.timestamp())
-                if schedule_start:
-                    logging.debug(
-                        'Switch on %s at %s %+.1f min',
-                        e.location.value,
-                        datetime.fromtimestamp(e_start+r_time_1).strftime(
-                            '%Y-%m-%d %H:%M:%S'),
-                        r_time_1 / 60)
-                    try:
-                        switch_type[config[e.location.value]['type']](
-                            e.location.value, True, e_start+r_time_1)
-                        if second_switch > 0:
-                            switch_type[config[e.location.value]['type']](
-                                e.location.value, True,
-                                e_start+r_time_1+second_switch)
-                    except:
-                        logging.critical('Error: %s at %s + %s',
-                                         e.summary.value,
-                                         datetime.fromtimestamp(
-                                             e_start).strftime(
-                                                '%Y-%m-%d %H:%M:%S'),
-                                         r_time_1, '!')
-                if schedule_end:
-                    logging.debug(
-                        'Switch off %s at %s %+.1f min',
-                        e.location.value,
-                        datetime.fromtimestamp(e_end+r_time_2).strftime(
-                            '%Y-%m-%d %H:%M:%S'),
-                        r_time_2 / 60)
-                    try:
-                        switch_type[config[e.location.value]['type']](
-                            e.location.value, False, e_end+r_time_2)
-                        if second_switch > 0:
-                            switch_type[config[e.location.value]['type']](
-                                e.location.value, False,
-                                e_end+r_time_2+second_switch)
-                    except:
-                        logging.critical('Error for %s at %s + %s',
-                                         e.summary.value,
-                                         datetime.fromtimestamp(
-                                             e_end).strftime(
-                                                '%Y-%m-%d %H:%M:%S'),
-                                         r_time_2)
-                else:
-                    logging.debug('End time %s is after current scheduler'
-                                  ' interval, skipping end of event.',
-                                  datetime.fromtimestamp(
-                                      e_end).strftime('%Y-%m-%d %H:%M:%S'))
-            else:
-                logging.debug('Start and end time are not in current'
-                              ' interval, skipping...')
-        logging.debug('Scheduler queue:\n%s', s.queue)
+    # get start and end times for next time interval
+    dt_start, dt_end = get_interval(datetime.today(), interval)
+    if schedule_interval(sources, dt_start, dt_end, args) or reconciled:
         logging.info('Start scheduler at %s',
                      time.strftime('%Y-%m-%d %H:%M:%S'))
         s.run()
         logging.info('<><><> Completed scheduled events'
                      ' for this time interval. <><><>')
-        try:
-            ser.close()
-        finally:
-            logging.debug('No serial used, nothing to close.')
+        s.log_stats()
     else:
         logging.info('<> No calendar events in this time interval. <>')
+    s.stop()
+    close_hardware()
+    journal.close()
+    write_metrics()
 
 
 if __name__ == '__main__':
+    # third-party backends import caltimer to register their types
+    sys.modules.setdefault('caltimer', sys.modules[__name__])
     main()
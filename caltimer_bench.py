@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+
+# #######################################################
+# Benchmark of caltimer with synthetic calendars        #
+#                                                       #
+# Generates calendars with the given number of events,  #
+# serves them from a local CalDAV stand-in and times    #
+# each phase of a caltimer run:                         #
+#   connect   : principal and calendar discovery        #
+#   sync      : first download into the event store     #
+#   unchanged : sync check of an unchanged calendar     #
+#   expand    : expansion of the occurrences            #
+#   find      : events of each interval from the store  #
+#   query     : calendar-query of one interval (sync    #
+#               disabled)                               #
+#   options   : parsing of the event descriptions       #
+#   schedule  : planning of the switch events           #
+#   dispatch  : execution with the recording backend    #
+#                                                       #
+# Results are written as JSON, e.g.                     #
+#   caltimer_bench.py -n 10 1000 100000 -o bench.json   #
+# #######################################################
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+
+import caltimer
+
+NS_C = caltimer.NS_C
+NS_CS = caltimer.NS_CS
+CALENDAR = '/calendars/bench/'
+
+# description options of the events
+SUN_OPTIONS = '[sun]\nstart : set\nstart_offset : -15'
+RANDOM_OPTIONS = '[random]\nall : 10'
+# recurrence rules of the recurring events
+RRULES = ('FREQ=DAILY', 'FREQ=WEEKLY;BYDAY=MO,WE,FR',
+          'FREQ=DAILY;INTERVAL=2;COUNT=30')
+
+# ini file of the benchmark, the switches are added per type
+BENCH_INI = """
+[DEFAULT]
+rf_code     : rf433
+rf433       : /bin/true
+protocol    : 1
+pulselength : 350
+zap_base    : FFF00
+kopp_time   : 100
+max_pulse   : 10
+gpio        : 17
+ser_port    : /dev/null
+
+[LOGGING]
+loglevel    : WARNING
+
+[CALENDAR]
+calname     : Bench
+latitude    : 53.55
+longitude   : 9.99
+interval    : 15
+"""
+
+SWITCH_OPTIONS = {
+    'rf':    'oncode : %d\noffcode : %d' % (349491, 349500),
+    'comag': 'system : 01000\nreceiver : 00101',
+    'zap':   'channel : 00FFF\nkey : 2',
+    'kopp':  'key_off : 03\ntransmit_1 : 4B13\ntransmit_2 : 03',
+    'gpio':  'pin : %(pin)s',
+    'pulse': 'pin : %(pin)s\non : 1\noff : 5',
+    'dummy': '',
+    }
+
+
+def ics_time(dt):
+    return dt.strftime('%Y%m%dT%H%M%S')
+
+
+def generate_calendar(rng, events, start, days, recurring, sun, rand,
+                      switches):
+    # Returns href: (etag, data, start, end) of the calendar objects,
+    # start/end is the time range used by the calendar-query filter
+    names = [name for name, weight in switches for _ in range(weight)]
+    objects = {}
+    for i in range(events):
+        e_start = start + timedelta(
+            minutes=rng.randrange(days * 24 * 60))
+        e_end = e_start + timedelta(minutes=rng.randrange(5, 120))
+        lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:caltimer_bench',
+                 'BEGIN:VEVENT', 'UID:bench-%d' % i,
+                 'DTSTAMP:20180101T000000Z',
+                 'DTSTART:%s' % ics_time(e_start),
+                 'DTEND:%s' % ics_time(e_end),
+                 'SUMMARY:Bench %d' % i,
+                 'LOCATION:%s' % rng.choice(names)]
+        until = e_end.timestamp()
+        if rng.random() < recurring:
+            # recurring events start before the benchmark period
+            shift = timedelta(days=rng.randrange(1, 30))
+            lines[6] = 'DTSTART:%s' % ics_time(e_start - shift)
+            lines[7] = 'DTEND:%s' % ics_time(e_end - shift)
+            lines.append('RRULE:%s' % rng.choice(RRULES))
+            until = float('inf')
+        options = []
+        if rng.random() < sun:
+            options.append(SUN_OPTIONS)
+        if rng.random() < rand:
+            options.append(RANDOM_OPTIONS)
+        if options:
+            lines.append('DESCRIPTION:%s' % '\\n'.join(
+                options).replace('\n', '\\n'))
+        lines += ['END:VEVENT', 'END:VCALENDAR']
+        href = '%sbench-%d.ics' % (CALENDAR, i)
+        objects[href] = ('"%d"' % i, '\r\n'.join(lines) + '\r\n',
+                         e_start.timestamp() - 86400, until)
+    return objects
+
+
+class CalDAVHandler(BaseHTTPRequestHandler):
+    # Minimal CalDAV server with one calendar, enough for the caldav
+    # client discovery and the requests of caltimer
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length) if length else b''
+        return ElementTree.fromstring(data) if data.strip() else None
+
+    def reply(self, status, data, content_type='application/xml'):
+        data = data.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', '%s; charset=utf-8' % content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('DAV', '1, 2, calendar-access')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def multistatus(self, responses, extra=''):
+        self.reply(207, '<?xml version="1.0" encoding="utf-8"?>'
+                   '<d:multistatus xmlns:d="DAV:" xmlns:c="%s" xmlns:cs="%s">'
+                   '%s%s</d:multistatus>' % (NS_C, NS_CS, ''.join(responses),
+                                             extra))
+
+    def prop(self, path, tag):
+        # XML of the property tag of resource path, None if not defined
+        server = self.server
+        name = tag.split('}')[-1]
+        if path in ('/', '/principal/'):
+            values = {
+                'resourcetype': '<d:collection/><d:principal/>',
+                'current-user-principal': '<d:href>/principal/</d:href>',
+                'calendar-home-set': '<d:href>/calendars/</d:href>',
+                'displayname': 'bench'}
+        elif path == '/calendars/':
+            values = {'resourcetype': '<d:collection/>',
+                      'displayname': 'calendars'}
+        elif path == CALENDAR:
+            values = {
+                'resourcetype': '<d:collection/><c:calendar/>',
+                'displayname': 'Bench',
+                'getctag': server.ctag,
+                'sync-token': server.sync_token,
+                'supported-calendar-component-set':
+                    '<c:comp name="VEVENT"/>'}
+        elif path in server.objects:
+            values = {'resourcetype': '',
+                      'getetag': xml_escape(server.objects[path][0]),
+                      'getcontenttype': 'text/calendar'}
+        else:
+            return None
+        if name not in values:
+            return None
+        prefix = {NS_C: 'c', NS_CS: 'cs'}.get(tag[1:].split('}')[0], 'd')
+        return '<%s:%s>%s</%s:%s>' % (prefix, name, values[name], prefix,
+                                       name)
+
+    def response(self, path, tags):
+        found = []
+        missing = []
+        for tag in tags:
+            value = self.prop(path, tag)
+            if value is None:
+                ns, name = tag[1:].split('}')
+                missing.append('<x:%s xmlns:x="%s"/>' % (name, ns))
+            else:
+                found.append(value)
+        xml = '<d:response><d:href>%s</d:href>' % xml_escape(path)
+        if found:
+            xml += ('<d:propstat><d:prop>%s</d:prop>'
+                    '<d:status>HTTP/1.1 200 OK</d:status></d:propstat>'
+                    % ''.join(found))
+        if missing:
+            xml += ('<d:propstat><d:prop>%s</d:prop><d:status>'
+                    'HTTP/1.1 404 Not Found</d:status></d:propstat>'
+                    % ''.join(missing))
+        return xml + '</d:response>'
+
+    def object_response(self, href):
+        etag, data = self.server.objects[href][:2]
+        return ('<d:response><d:href>%s</d:href><d:propstat><d:prop>'
+                '<d:getetag>%s</d:getetag><c:calendar-data>%s'
+                '</c:calendar-data></d:prop><d:status>HTTP/1.1 200 OK'
+                '</d:status></d:propstat></d:response>' % (
+                    xml_escape(href), xml_escape(etag), xml_escape(data)))
+
+    def do_PROPFIND(self):
+        self.server.requests += 1
+        path = self.path if self.path.endswith(('/', '.ics')) else (
+            self.path + '/')
+        tree = self.body()
+        tags = []
+        if tree is not None:
+            tags = [p.tag for p in tree.iter() if p.tag != tree.tag and
+                    p.tag != '{DAV:}prop']
+        if self.prop(path, '{DAV:}resourcetype') is None:
+            self.reply(404, '')
+            return
+        responses = [self.response(path, tags)]
+        if self.headers.get('Depth', '0') == '1':
+            if path == '/calendars/':
+                children = [CALENDAR]
+            elif path == CALENDAR:
+                children = list(self.server.objects)
+            else:
+                children = []
+            responses += [self.response(child, tags) for child in children]
+        self.multistatus(responses)
+
+    def do_REPORT(self):
+        self.server.requests += 1
+        tree = self.body()
+        report = tree.tag.split('}')[-1]
+        objects = self.server.objects
+        if report == 'sync-collection':
+            token = tree.findtext('{DAV:}sync-token')
+            hrefs = [] if token == self.server.sync_token else list(objects)
+            self.multistatus(
+                [self.response(href, ['{DAV:}getetag']) for href in hrefs],
+                '<d:sync-token>%s</d:sync-token>' % self.server.sync_token)
+        elif report == 'calendar-multiget':
+            self.multistatus([self.object_response(href.text)
+                              for href in tree.iter('{DAV:}href')
+                              if href.text in objects])
+        elif report == 'calendar-query':
+            time_range = tree.find('.//{%s}time-range' % NS_C)
+            q_start, q_end = (
+                datetime.strptime(time_range.get(a), '%Y%m%dT%H%M%SZ')
+                .replace(tzinfo=timezone.utc).timestamp()
+                for a in ('start', 'end'))
+            self.multistatus([self.object_response(href)
+                              for href, (_, _, start, end) in objects.items()
+                              if start < q_end and end > q_start])
+        else:
+            self.reply(501, '')
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path not in self.server.objects:
+            self.reply(404, '')
+            return
+        self.reply(200, self.server.objects[self.path][1], 'text/calendar')
+
+
+def start_server(objects):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CalDAVHandler)
+    server.objects = objects
+    server.ctag = 'bench-%d' % len(objects)
+    server.sync_token = 'http://caltimer/bench/sync/%d' % len(objects)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Timer:
+    # Sums the duration and the DAV round trips of the phases
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, phase, function, *args):
+        caltimer.dav_requests = 0
+        t = time.perf_counter()
+        result = function(*args)
+        duration = time.perf_counter() - t
+        seconds, requests = self.phases.get(phase, (0.0, 0))
+        self.phases[phase] = (seconds + duration,
+                              requests + caltimer.dav_requests)
+        return result
+
+
+def configure(switches, workdir):
+    # Set up caltimer with the benchmark ini file and the recording
+    # backend, returns the switch names with their weight
+    config = configparser.ConfigParser()
+    config.read_string(BENCH_INI)
+    config['CALENDAR']['sun_table'] = os.path.join(workdir, 'sun.dat')
+    names = []
+    pin = 2
+    for type, count in switches:
+        for i in range(count):
+            name = '%s %d' % (type, i + 1)
+            config.read_string('[%s]\ntype : %s\n%s' % (
+                name, type, SWITCH_OPTIONS[type] % {'pin': pin}))
+            pin += 1
+            names.append((name, 1))
+    caltimer.config = config
+    caltimer.s = caltimer.Simulator(open(os.devnull, 'w'))
+    caltimer.airtime = caltimer.AirtimePlanner(0.1)
+    caltimer.init_simulation()
+    if not caltimer.compile_switches():
+        sys.exit(1)
+    return names
+
+
+def parse_options(events):
+    # description compiling as done by schedule_event
+    caltimer.event_rules.clear()
+    for e, e_start_dt, e_end_dt in events:
+        caltimer.event_rule(e)
+
+
+def schedule(events, dt_start, dt_end):
+    def sun(day):
+        return caltimer.get_sun(day, None, None)
+    for e, e_start_dt, e_end_dt in events:
+        caltimer.schedule_event(e, e_start_dt, e_end_dt, dt_start, dt_end,
+                                sun)
+    caltimer.commit_plan()
+    caltimer.airtime.commit()
+
+
+def bench(args, events, workdir):
+    rng = random.Random(args.seed)
+    start = datetime.combine(datetime.today() + timedelta(days=1),
+                             datetime.min.time())
+    switches = configure(args.switches, workdir)
+    t = time.perf_counter()
+    objects = generate_calendar(rng, events, start, args.days,
+                                args.recurring, args.sun, args.random,
+                                switches)
+    generate = time.perf_counter() - t
+    server = start_server(objects)
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    timer = Timer()
+    interval = int(caltimer.config['CALENDAR']['interval'])
+    try:
+        calendar = timer('connect', caltimer.connect_calendar, url, 'Bench')
+        if calendar is None:
+            sys.exit(1)
+        store = caltimer.EventStore(os.path.join(workdir, 'events-%d.db' %
+                                                 events), url, args.expand)
+        sync = caltimer.CalendarSync(calendar, store)
+        timer('sync', sync.refresh)
+        timer('unchanged', sync.refresh)
+        dt_start, dt_end = start, start + timedelta(minutes=interval)
+        timer('expand', store.find, dt_start, dt_end)
+        timer('query', caltimer.find_events, calendar, None, None, dt_start,
+              dt_end)
+        found = scheduled = 0
+        for i in range(args.intervals):
+            events_found = timer('find', store.find, dt_start, dt_end)
+            found += len(events_found)
+            timer('options', parse_options, events_found)
+            timer('schedule', schedule, events_found, dt_start, dt_end)
+            scheduled += len(caltimer.s.heap)
+            timer('dispatch', caltimer.s.run, dt_end.timestamp())
+            dt_start, dt_end = dt_end, dt_end + timedelta(minutes=interval)
+        timer('dispatch', caltimer.s.run)
+        store.db.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'events': events,
+        'intervals': args.intervals,
+        'occurrences_found': found,
+        'switch_actions': scheduled,
+        'generate_seconds': round(generate, 6),
+        'phases': {phase: {'seconds': round(seconds, 6),
+                           'requests': requests}
+                   for phase, (seconds, requests) in timer.phases.items()},
+        'server_requests': server.requests,
+        }
+
+
+def switch_mix(value):
+    # "rf:4,kopp:2" -> [('rf', 4), ('kopp', 2)]
+    mix = []
+    for item in value.split(','):
+        type, _, count = item.partition(':')
+        if type not in SWITCH_OPTIONS:
+            raise argparse.ArgumentTypeError('unknown switch type %s' % type)
+        mix.append((type, int(count or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--events', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help='number of calendar events, one run per value')
+    parser.add_argument('--days', type=int, default=7,
+                        help='period of the generated events in days')
+    parser.add_argument('--recurring', type=float, default=0.3,
+                        help='share of recurring events')
+    parser.add_argument('--sun', type=float, default=0.2,
+                        help='share of events with [sun] options')
+    parser.add_argument('--random', type=float, default=0.2,
+                        help='share of events with [random] options')
+    parser.add_argument('--switches', type=switch_mix,
+                        default='rf:4,comag:2,zap:1,kopp:2,gpio:2,pulse:1',
+                        help='switch types and number of switches per type')
+    parser.add_argument('--intervals', type=int, default=96,
+                        help='number of scheduler intervals to run')
+    parser.add_argument('--expand', type=int, default=2,
+                        help='days of the occurrence expansion')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the calendar generator')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON result file (default stdout)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('events', 'output')},
+        'runs': [],
+        }
+    with tempfile.TemporaryDirectory() as workdir:
+        for events in args.events:
+            run = bench(args, events, workdir)
+            logging.warning('%s events: %s', events, ', '.join(
+                '%s %.3f s' % (phase, values['seconds'])
+                for phase, values in run['phases'].items()))
+            results['runs'].append(run)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
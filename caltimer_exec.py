@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+# #######################################################
+# Executor of the timeline compiled by                  #
+#   caltimer.py --compile FILE                          #
+#                                                       #
+# Fires the switch commands of the next interval        #
+# without the calendar libraries: the timeline is       #
+# memory mapped and only the hardware library of the    #
+# switches used is imported. Started by cron like       #
+# caltimer.py, about 1 min before each interval.        #
+# #######################################################
+
+import logging
+import sys
+import mmap
+import struct
+import json
+import time
+import subprocess
+import argparse
+import importlib
+from datetime import datetime, timedelta
+
+# Must match TIMELINE_* of caltimer.py
+TIMELINE_MAGIC = b'CTTL'
+TIMELINE_VERSION = 1
+TIMELINE_HEADER = struct.Struct('<4sIII')
+TIMELINE_RECORD = struct.Struct('<dHBBI')
+TIMELINE_KINDS = ('dummy', 'gpio', 'codesend', 'rpi-rf', 'kopp')
+
+logging.basicConfig(
+    stream=sys.stderr,
+    format='%(asctime)s - %(levelname)s - %(module)s - %(message)s',
+    level=logging.INFO)
+
+
+class Timeline:
+    # Memory mapped timeline file
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, length = TIMELINE_HEADER.unpack_from(
+            self.map)
+        if magic != TIMELINE_MAGIC or version != TIMELINE_VERSION:
+            raise ValueError('%s is not a caltimer timeline (version %s)'
+                             % (filename, TIMELINE_VERSION))
+        meta = json.loads(self.map[TIMELINE_HEADER.size:
+                                   TIMELINE_HEADER.size + length])
+        self.switches = meta['switches']
+        self.payloads = meta['payloads']
+        self.settings = meta['settings']
+        self.offset = TIMELINE_HEADER.size + length
+
+    def record(self, index):
+        return TIMELINE_RECORD.unpack_from(
+            self.map, self.offset + index * TIMELINE_RECORD.size)
+
+    def first(self, stime):
+        # index of the first record at or after stime
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < stime:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def between(self, t_start, t_end):
+        for index in range(self.first(t_start), self.count):
+            entry = self.record(index)
+            if entry[0] >= t_end:
+                return
+            yield entry
+
+
+class Hardware:
+    # Hardware of the timeline commands, opened before the first command
+    # is due, so the command itself is only the write. rpi-rf and Kopp
+    # commands name their transmitter pin and nanoCUL port, older
+    # timelines use the first one of the settings.
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.gpio = None
+        self.pins = set()
+        # GPIO pin: RFDevice
+        self.rfdevices = {}
+        # serial port: Serial
+        self.serials = {}
+
+    def pin(self, payload):
+        # transmitter of an rpi-rf command
+        if len(payload) > 3:
+            return payload[3]
+        return int(str(self.settings['gpio']).split(',')[0])
+
+    def port(self, payload):
+        # nanoCUL of a Kopp command
+        if len(payload) > 1:
+            return payload[1]
+        return self.settings['ser_port'].split(',')[0].strip()
+
+    def prepare(self, kind, payload):
+        if kind == 'gpio':
+            if self.gpio is None:
+                self.gpio = importlib.import_module('RPi.GPIO')
+                self.gpio.setmode(self.gpio.BCM)
+                self.gpio.setwarnings(False)
+            if payload[0] not in self.pins:
+                self.gpio.setup(payload[0], self.gpio.OUT)
+                self.pins.add(payload[0])
+        elif kind == 'rpi-rf':
+            pin = self.pin(payload)
+            if pin not in self.rfdevices:
+                RFDevice = importlib.import_module('rpi_rf').RFDevice
+                self.rfdevices[pin] = RFDevice(pin)
+                self.rfdevices[pin].enable_tx()
+        elif kind == 'kopp':
+            port = self.port(payload)
+            if port not in self.serials:
+                serial = importlib.import_module('serial')
+                self.serials[port] = serial.Serial(
+                    port, 38400, timeout=float(self.settings['ser_timeout']))
+
+    def execute(self, name, kind, payload):
+        if kind == 'gpio':
+            self.gpio.output(*payload)
+        elif kind == 'codesend':
+            subprocess.call(payload)
+        elif kind == 'rpi-rf':
+            self.rfdevices[self.pin(payload)].tx_code(*payload[:3])
+        elif kind == 'kopp':
+            # the version reply confirms the frame, as in
+            # caltimer.CulTransport.write
+            port = self.port(payload)
+            serial = self.serials[port]
+            serial.reset_input_buffer()
+            serial.write((payload[0] + '\nV\n').encode())
+            deadline = time.monotonic() + 2 * float(
+                self.settings['ser_timeout'])
+            while time.monotonic() < deadline:
+                line = serial.readline().strip()
+                if line:
+                    logging.debug('nanoCUL reply: %s', line)
+                if line.startswith(b'V'):
+                    break
+            else:
+                raise OSError('code %s not confirmed by the nanoCUL %s'
+                              % (payload[0], port))
+        else:
+            logging.warning('Dummy event action: %s', name)
+
+    def close(self):
+        for rfdevice in self.rfdevices.values():
+            rfdevice.cleanup()
+        for serial in self.serials.values():
+            serial.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('timeline', nargs='?',
+                        default='/var/lib/caltimer/timeline.bin',
+                        help='timeline file of caltimer.py --compile')
+    parser.add_argument('-t', '--time-interval', type=int,
+                        help='interval in minutes (default: the interval '
+                        'of the timeline)')
+    args = parser.parse_args()
+
+    try:
+        timeline = Timeline(args.timeline)
+    except (OSError, ValueError) as e:
+        logging.error('Unable to read the timeline: %s', e)
+        return 1
+    interval = args.time_interval or timeline.settings['interval']
+    # next interval as in caltimer.get_interval
+    dt = datetime.today()
+    dt_start = dt + timedelta(minutes=interval - dt.minute % interval,
+                              seconds=-dt.second,
+                              microseconds=-dt.microsecond)
+    dt_end = dt_start + timedelta(minutes=interval)
+    entries = list(timeline.between(dt_start.timestamp(),
+                                    dt_end.timestamp()))
+    if not entries:
+        if timeline.count and timeline.record(timeline.count - 1)[0] < \
+                dt_end.timestamp():
+            logging.warning('Timeline %s ends before this interval, is '
+                            'the planner running?', args.timeline)
+        return 0
+
+    hardware = Hardware(timeline.settings)
+    try:
+        for stime, switch, state, kind, payload in entries:
+            hardware.prepare(TIMELINE_KINDS[kind], timeline.payloads[payload])
+        for stime, switch, state, kind, payload in entries:
+            remaining = stime - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            name = timeline.switches[switch]
+            try:
+                hardware.execute(name, TIMELINE_KINDS[kind],
+                                 timeline.payloads[payload])
+            except Exception as e:
+                logging.error('Switch command of %s failed: %s', name, e)
+                continue
+            logging.info('%s %s at %s', name,
+                         {0: 'OFF', 1: 'ON'}.get(state, '-'),
+                         time.strftime('%H:%M:%S', time.localtime(stime)))
+    finally:
+        hardware.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())